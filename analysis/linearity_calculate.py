@@ -2,35 +2,49 @@
 Analyse linearity data stacks.
 Script taken from https://github.com/monocle-h2020/camera_calibration/blob/master/analysis/linearity_raw.py
 
+The mean stacks (stack files or legacy NPY stacks) are read in chunks of rows,
+which are processed in parallel, so the full data set is never loaded into
+memory. For every pixel, a straight line is fitted to the unsaturated data
+points, giving maps of the Pearson r, slope, intercept, and residual.
+
 Call signature:
-    python linearity.py E:/linearity/stacks/
+    python linearity_calculate.py E:/linearity/stacks/ [workers]
 """
 import numpy as np
-from matplotlib import pyplot as plt
-from spectacle import plot, linearity as lin, io, symmetric_percentiles
+from spectacle import linearity as lin
 from pathlib import Path
 from sys import argv
+from os import cpu_count
+import fpc
 
 # Temporary
 saturation = 0.95*(2**16 - 1)
 
-# Get the filename from the command line
+# Get the filename and number of workers from the command line
 folder = Path(argv[1])
+workers = int(argv[2]) if len(argv) > 2 else cpu_count()
 
 # Save locations
 savefolder = Path("results")
 save_to_result = savefolder/"linearity_raw.npy"
 
-# Load the data
-intensities_with_errors, means = io.load_means(folder, retrieve_value=lin.filename_to_intensity)
-intensities, intensity_errors = intensities_with_errors.T
-print("Loaded data")
+if __name__ == "__main__":
+    # Find the data and get the intensity for each stack
+    filenames = fpc.io.find_stacks(folder)
+    intensities_with_errors = np.array([lin.filename_to_intensity(filename) for filename in filenames])
+    intensities, intensity_errors = intensities_with_errors.T
+    print(f"Found {len(filenames)} stacks")
 
-# Calculate the Pearson r value for each pixel
-print("Calculating Pearson r...", end=" ", flush=True)
-r, saturated = lin.calculate_pearson_r_values(intensities, means, saturate=saturation)
-print("... Done!")
+    # Fit the response of each pixel
+    print(f"Fitting linearity using {workers} workers...", end=" ", flush=True)
+    maps = fpc.linearity.fit_linearity(intensities, filenames, saturation=saturation, workers=workers)
+    print("... Done!")
+    print(f"{np.isnan(maps['r']).sum()} pixels have fewer than two unsaturated data points")
 
-# Save the results
-np.save(save_to_result, r)
-print(f"Saved results to '{save_to_result}'")
+    # Save the results
+    np.save(save_to_result, maps["r"])
+    print(f"Saved results to '{save_to_result}'")
+    for name in fpc.linearity.map_names[1:]:
+        save_to_map = savefolder/f"linearity_raw_{name}.npy"
+        np.save(save_to_map, maps[name])
+        print(f"Saved {name} map to '{save_to_map}'")
@@ -6,7 +6,10 @@ Script from https://github.com/monocle-h2020/camera_calibration/blob/master/anal
 
 Command line arguments:
     * `folder`: the folder containing linearity data stacks. These should be
-    NPY stacks taken at different exposure conditions, with the same ISO speed.
+    stacks (stack files or legacy NPY stacks) taken at different exposure
+    conditions, with the same ISO speed.
+
+Only the pixel of interest is read from each stack.
 """
 
 import numpy as np
@@ -14,6 +17,7 @@ from sys import argv
 from spectacle import io, plot, linearity as lin
 from pathlib import Path
 from matplotlib import pyplot as plt
+import fpc
 
 # Get the data folder from the command line
 folder = io.path_from_input(argv)
@@ -25,15 +29,22 @@ folder = io.path_from_input(argv)
 # Save locations
 savefolder = Path("results")
 
-# Load the data
-intensities_with_errors, means = io.load_means(folder, retrieve_value=lin.filename_to_intensity)
-intensities_with_errors, stds = io.load_stds(folder, retrieve_value=lin.filename_to_intensity)
+# Pixel or region of interest to plot; regions are averaged
+pixel = np.s_[700, 700]
+
+# Find the data and get the intensity for each stack
+filenames = fpc.io.find_stacks(folder)
+intensities_with_errors = np.array([lin.filename_to_intensity(filename) for filename in filenames])
 intensities, intensity_errors = intensities_with_errors.T
+
+# Load the data for one pixel only
+m = fpc.linearity.response(filenames, pixel, name="mean")
+s = fpc.linearity.response(filenames, pixel, name="stds")
+if m.ndim > 1:
+    m, s = m.reshape(len(m), -1).mean(axis=1), s.reshape(len(s), -1).mean(axis=1)
 print("Loaded data")
 
 # Plot the data for one pixel
-m = means[:, 700, 700]
-s = stds[:, 700, 700]
 best_fit = np.polyfit(intensities, m, 1)
 xfit = [0, 5000]
 best_fit_line = np.polyval(best_fit, xfit)
@@ -16,5 +16,11 @@ label = filename.stem
 # Load the RAW file as an array
 img = fpc.io.load_image_blackfly(filename)
 
+# Print a summary of the pixel values
+summary = fpc.statistics.describe_raw(img)
+print(f"{label}: min {summary['min']}, max {summary['max']}, mean {summary['mean']:.1f}, median {summary['median']:.0f}")
+print(f"P_0.1 = {summary['P_0.1']:.0f}, P_99.9 = {summary['P_99.9']:.0f}")
+print(f"Saturated pixels: {summary['nr_saturated']} ({100*summary['fraction_saturated']:.2f}%)")
+
 # Show the RAW file and its histogram
 fpc.plot.show_testplot(img, bins=np.linspace(0, 65536, 250), label="RAW Pixel value")
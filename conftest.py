@@ -0,0 +1,3 @@
+"""
+pytest configuration: makes the `fpc` package in this folder importable from the tests (in tests/).
+"""
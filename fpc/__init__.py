@@ -1 +1,20 @@
-from . import io, plot, stokes
+"""
+Data processing for the FLIR Blackfly colour/polarisation camera.
+
+Submodules are imported when they are first used (e.g. `fpc.plot` only imports matplotlib when `fpc.plot` is accessed), so scripts and worker processes that do not plot do not pay for importing the plotting libraries.
+"""
+from importlib import import_module
+
+submodules = ("calibration", "instrumentation", "io", "linearity", "live", "pipeline", "plot", "quality", "render", "stackfile", "statistics", "stokes", "timeseries")
+__all__ = list(submodules)
+
+
+def __getattr__(name):
+    # Import submodules on first access
+    if name in submodules:
+        return import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted({*globals(), *submodules})
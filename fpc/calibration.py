@@ -0,0 +1,181 @@
+"""
+Calibration of RAW images: bias, linearity, and flat-field correction.
+
+The correction products are combined once into a single per-pixel offset and gain, so a calibration is applied as `(raw - offset) * gain` in two vectorised passes, regardless of how many products are used.
+The products are built from mean stacks (see `fpc.io.load_stack`) and linearity maps (see `fpc.linearity.fit_linearity`), and are saved as stack files (see `fpc.stackfile`) together with the camera settings they apply to.
+Loaded calibrations are kept in a small in-memory cache, keyed by folder and camera settings; see `get_calibration`.
+"""
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+from . import io, stackfile
+
+# Size of the repeating pattern of polariser and colour filters on the sensor
+site_shape = (4, 4)
+
+# Maximum number of calibrations kept in memory
+cache_size = 4
+_cache = OrderedDict()
+
+
+def normalise_per_site(data):
+    """
+    Divide each pixel in `data` by the mean of all pixels with the same polariser and colour filter (see `site_shape`), ignoring NaNs.
+    This keeps the differences between filters, which are handled elsewhere, and only removes pixel-to-pixel variations.
+    """
+    normalised = np.array(data, dtype=np.float32)
+    for i in range(site_shape[0]):
+        for j in range(site_shape[1]):
+            site = normalised[i::site_shape[0], j::site_shape[1]]
+            site /= np.nanmean(site)
+    return normalised
+
+
+class Calibration:
+    """
+    Calibration for RAW images, as a per-pixel `offset` and `gain`: calibrated = (raw - offset) * gain.
+    Use `from_products` to create one from a bias frame, flat field, and/or linearity maps.
+    `settings` is a dictionary of the camera settings (e.g. exposure time) that this calibration applies to.
+    """
+    def __init__(self, offset, gain, settings=None):
+        self.offset = np.asarray(offset, dtype=np.float32)
+        self.gain = np.asarray(gain, dtype=np.float32)
+        self.settings = dict(settings) if settings is not None else {}
+
+        if self.offset.shape != self.gain.shape:
+            raise ValueError(f"Offset {self.offset.shape} and gain {self.gain.shape} must have the same shape.")
+
+    def __repr__(self):
+        return f"{type(self).__name__}(shape={self.shape}, settings={self.settings})"
+
+    @property
+    def shape(self):
+        return self.offset.shape
+
+    @classmethod
+    def from_products(cls, bias=None, flat=None, slope=None, intercept=None, settings=None, shape=io.full_shape):
+        """
+        Combine correction products into a single offset and gain.
+        `bias` is the mean of a stack of dark frames.
+        `slope` and `intercept` are linearity maps from `fpc.linearity.fit_linearity`, fitted to the RAW (not bias-corrected) response. If given, they replace the bias: the response of each pixel is scaled to the mean response of its polariser/colour site (see `normalise_per_site`).
+        `flat` is the mean of a stack of flat-field frames, after bias or linearity correction; it is normalised per polariser/colour site.
+        Pixels with non-finite slopes (e.g. always saturated) or flat-field values are left uncorrected by that product.
+        """
+        # Determine the shape from the first product that is given
+        for product in (bias, flat, slope):
+            if product is not None:
+                shape = np.shape(product)
+                break
+        offset = np.zeros(shape, dtype=np.float32)
+        gain = np.ones(shape, dtype=np.float32)
+
+        # Bias or linearity correction
+        if slope is not None:
+            if intercept is None:
+                raise ValueError("A linearity correction needs both the slope and intercept maps.")
+            relative_slope = normalise_per_site(slope)
+            good = np.isfinite(relative_slope) & np.isfinite(intercept) & (relative_slope > 0)
+            offset[good] = np.asarray(intercept)[good]
+            gain[good] = 1 / relative_slope[good]
+        elif bias is not None:
+            offset[:] = bias
+
+        # Flat-field correction
+        if flat is not None:
+            relative_flat = normalise_per_site(flat)
+            good = np.isfinite(relative_flat) & (relative_flat > 0)
+            gain[good] /= relative_flat[good]
+
+        return cls(offset, gain, settings=settings)
+
+    def crop(self, region):
+        """
+        Get the calibration for a `region` of the sensor, e.g. for images of a region of interest. The offset and gain are not copied.
+        """
+        if region == tuple(slice(0, length) for length in self.shape):
+            return self
+        return type(self)(self.offset[region], self.gain[region], settings=self.settings)
+
+    def apply(self, raw, region=(), out=None):
+        """
+        Calibrate a `region` of a RAW image (e.g. a memory map or array) in two vectorised passes, writing the result to `out` (float32) if given.
+        `region` is the index of `raw` within the full image, so the corresponding part of the offset and gain is used.
+        The data in `raw` are not changed. Masks are not applied; see `fpc.io.load_image_blackfly`.
+        """
+        out = np.subtract(np.ma.getdata(raw), self.offset[region], out=out, dtype=np.float32)
+        np.multiply(out, self.gain[region], out=out)
+        return out
+
+    def save(self, filename):
+        """
+        Save the calibration, including its settings, to a stack file.
+        """
+        stackfile.save_stack(filename, {"offset": self.offset, "gain": self.gain}, metadata={"settings": self.settings})
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a calibration from a stack file.
+        """
+        stack = stackfile.StackFile(filename)
+        return cls(stack["offset"][...], stack["gain"][...], settings=stack.metadata.get("settings"))
+
+
+def find_calibration(folder, **settings):
+    """
+    Find the calibration file in `folder` whose settings match all the given `settings` (e.g. exposure_time=1000).
+    Raises a FileNotFoundError if there is no match and a ValueError if there are several.
+    """
+    matches = [filename for filename in sorted(Path(folder).glob(f"*{stackfile.extension}")) if all(stackfile.StackFile(filename).metadata.get("settings", {}).get(key) == value for key, value in settings.items())]
+
+    if len(matches) == 0:
+        raise FileNotFoundError(f"No calibration with settings {settings} in {folder}.")
+    elif len(matches) > 1:
+        raise ValueError(f"Multiple calibrations with settings {settings} in {folder}: {[match.name for match in matches]}")
+
+    return matches[0]
+
+
+def get_calibration(folder, **settings):
+    """
+    Get the calibration in `folder` for the given camera `settings` (see `find_calibration`).
+    The last `cache_size` calibrations are kept in memory, so repeated calls with the same settings do not read anything from disk.
+    """
+    key = (str(Path(folder).resolve()), tuple(sorted(settings.items())))
+
+    # Load the calibration if it is not in the cache yet, removing the least recently used one if the cache is full
+    if key in _cache:
+        _cache.move_to_end(key)
+    else:
+        _cache[key] = Calibration.load(find_calibration(folder, **settings))
+        if len(_cache) > cache_size:
+            _cache.popitem(last=False)
+
+    return _cache[key]
+
+
+def clear_cache():
+    """
+    Remove all calibrations from the cache, e.g. after the calibration files have changed.
+    """
+    _cache.clear()
+
+
+def load_products(bias=None, flat=None, linearity=None):
+    """
+    Load correction products from files, for `Calibration.from_products`.
+    `bias` and `flat` are mean stacks (stack files or legacy NPY stacks); `linearity` is the folder containing the slope and intercept maps saved by `analysis/linearity_calculate.py`.
+    The bias (or linearity correction) is subtracted from the flat field.
+    """
+    products = {}
+    if bias is not None:
+        products["bias"] = io.load_stack(bias, name="mean")
+    if linearity is not None:
+        products["slope"] = np.load(Path(linearity)/"linearity_raw_slope.npy")
+        products["intercept"] = np.load(Path(linearity)/"linearity_raw_intercept.npy")
+    if flat is not None:
+        # Correct the flat field for the bias/linearity first, without its flat field
+        correction = Calibration.from_products(**products)
+        products["flat"] = correction.apply(io.load_stack(flat, name="mean"))
+
+    return products
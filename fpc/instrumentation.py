@@ -0,0 +1,240 @@
+"""
+Opt-in instrumentation of the processing stages in fpc (loading, demosaicking, Stokes calculation, plotting).
+
+When enabled, every instrumented function (e.g. `fpc.io.load_image_blackfly`, `fpc.stokes.raw_to_stokes`, `fpc.plot.show_intensity_dolp_aolp`) produces a record with its wall time, CPU time (of the calling thread), bytes read from disk, and optionally its peak memory allocation (of numpy arrays and other Python objects, using tracemalloc).
+Records are labelled with the current frame (see `frame`) and the enclosing stage, if any, and can be written to a JSON-lines file and/or passed to a callback.
+When disabled (the default), an instrumented function only checks a single global variable before calling the original function.
+
+Example:
+    fpc.instrumentation.enable(saveto="timing.jsonl")
+    with fpc.instrumentation.frame("image_001"):
+        img = fpc.io.load_image_blackfly("image_001.raw")
+        img_stokes = fpc.stokes.raw_to_stokes(img)
+    fpc.instrumentation.print_summary()
+"""
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import partial, wraps
+
+# Current configuration; None if instrumentation is disabled
+_state = None
+
+# Per-thread frame label, stack of open stages, and number of bytes read
+_local = threading.local()
+
+
+class _State:
+    """
+    Configuration and collected records of enabled instrumentation.
+    """
+    def __init__(self, saveto=None, callback=None, track_memory=False):
+        self.file = open(saveto, "a") if saveto is not None else None
+        self.callback = callback
+        self.track_memory = track_memory
+        self.records = []
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.file is not None:
+                self.file.write(json.dumps(record) + "\n")
+                self.file.flush()
+        if self.callback is not None:
+            self.callback(record)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def enable(saveto=None, callback=None, track_memory=False):
+    """
+    Enable instrumentation.
+    Records are appended to the JSON-lines file `saveto` and/or passed to `callback` (a function that takes a dictionary), and are also kept in memory for `print_summary`.
+    If `track_memory` is True, the peak memory allocation of each stage is measured with tracemalloc, which slows down the processing considerably.
+    Peak memory is measured for the whole process, so it is only approximate if several threads are processing at once.
+    """
+    global _state
+    disable()
+    _state = _State(saveto=saveto, callback=callback, track_memory=track_memory)
+    if track_memory:
+        tracemalloc.start()
+
+
+def disable():
+    """
+    Disable instrumentation and close the output file, if any.
+    Returns the records that were collected.
+    """
+    global _state
+    if _state is None:
+        return []
+
+    state, _state = _state, None
+    state.close()
+    if state.track_memory:
+        tracemalloc.stop()
+    return state.records
+
+
+def is_enabled():
+    """
+    Check if instrumentation is enabled.
+    """
+    return _state is not None
+
+
+def _stack():
+    """
+    Get the stack of open stages in the current thread.
+    """
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def frame(label):
+    """
+    Label all records in this block (in the current thread) with a frame `label`, e.g. the name of the file being processed.
+    """
+    previous = getattr(_local, "frame", None)
+    _local.frame = str(label)
+    try:
+        yield
+    finally:
+        _local.frame = previous
+
+
+def count_bytes_read(nbytes):
+    """
+    Add `nbytes` to the number of bytes read by the current stage(s). Used in `fpc.io`.
+    """
+    if _state is None:
+        return
+    for open_stage in _stack():
+        open_stage["bytes_read"] += nbytes
+
+
+@contextmanager
+def stage(name):
+    """
+    Measure a block of code as a stage called `name`. Does nothing if instrumentation is disabled.
+    """
+    state = _state
+    if state is None:
+        yield
+        return
+
+    stack = _stack()
+    current = {"name": name, "bytes_read": 0, "peak": 0}
+
+    # Start measuring memory from the current level
+    if state.track_memory:
+        memory_now, peak_so_far = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak_so_far)
+        tracemalloc.reset_peak()
+        current["memory_start"] = memory_now
+
+    stack.append(current)
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        wall_time, cpu_time = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+        stack.pop()
+
+        record = {"stage": name,
+                  "frame": getattr(_local, "frame", None),
+                  "parent": stack[-1]["name"] if stack else None,
+                  "thread": threading.current_thread().name,
+                  "start": time.time() - wall_time,
+                  "wall_time": wall_time,
+                  "cpu_time": cpu_time,
+                  "bytes_read": current["bytes_read"]}
+
+        # Peak memory allocated during this stage, including any nested stages; passed on to the enclosing stage
+        if state.track_memory and tracemalloc.is_tracing():
+            current["peak"] = max(current["peak"], tracemalloc.get_traced_memory()[1])
+            record["peak_allocation"] = current["peak"] - current["memory_start"]
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], current["peak"])
+
+        state.emit(record)
+
+
+def instrumented(function=None, stage_name=None):
+    """
+    Decorator to measure every call to `function` as a stage (see `stage`), named `stage_name` or after the module and function (e.g. "stokes.raw_to_stokes").
+    """
+    if function is None:
+        return partial(instrumented, stage_name=stage_name)
+
+    name = stage_name if stage_name is not None else f"{function.__module__.split('.')[-1]}.{function.__qualname__}"
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        # Fast path: no instrumentation
+        if _state is None:
+            return function(*args, **kwargs)
+
+        with stage(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def read_records(filename):
+    """
+    Read the records from a JSON-lines file.
+    """
+    with open(filename) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    return records
+
+
+def summarise(records):
+    """
+    Summarise `records` per stage: number of calls and frames, total and mean wall time, total CPU time, total bytes read, and maximum peak allocation.
+    Returns a dictionary of stages, sorted by total wall time (highest first).
+    """
+    summary = {}
+    for record in records:
+        entry = summary.setdefault(record["stage"], {"calls": 0, "frames": set(), "wall_time": 0., "cpu_time": 0., "bytes_read": 0, "peak_allocation": None, "nested": record["parent"] is not None})
+        entry["calls"] += 1
+        entry["nested"] &= (record["parent"] is not None)
+        entry["frames"].add(record["frame"])
+        entry["wall_time"] += record["wall_time"]
+        entry["cpu_time"] += record["cpu_time"]
+        entry["bytes_read"] += record["bytes_read"]
+        if record.get("peak_allocation") is not None:
+            entry["peak_allocation"] = max(entry["peak_allocation"] or 0, record["peak_allocation"])
+
+    for entry in summary.values():
+        entry["frames"] = len(entry["frames"] - {None})
+        entry["mean_wall_time"] = entry["wall_time"] / entry["calls"]
+
+    summary = dict(sorted(summary.items(), key=lambda item: item[1]["wall_time"], reverse=True))
+    return summary
+
+
+def print_summary(records=None):
+    """
+    Print a table summarising `records` per stage (see `summarise`).
+    If `records` is None, the records collected in memory since instrumentation was enabled are used.
+    Stages that were only called from within other stages are indented; their times are included in those of the enclosing stages.
+    """
+    if records is None:
+        records = _state.records if _state is not None else []
+    summary = summarise(records)
+
+    print(f"\n{'Stage':<45} {'Calls':>6} {'Frames':>6} {'Wall [s]':>9} {'Mean [s]':>9} {'CPU [s]':>9} {'Read [MB]':>10} {'Peak [MB]':>10}")
+    for name, entry in summary.items():
+        label = f"  {name}" if entry["nested"] else name
+        peak = f"{entry['peak_allocation']/1e6:10.1f}" if entry["peak_allocation"] is not None else f"{'-':>10}"
+        print(f"{label:<45} {entry['calls']:>6} {entry['frames']:>6} {entry['wall_time']:>9.3f} {entry['mean_wall_time']:>9.3f} {entry['cpu_time']:>9.3f} {entry['bytes_read']/1e6:>10.1f} {peak}")
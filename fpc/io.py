@@ -1,8 +1,10 @@
 """
 File input/output for polarisation cameras.
 """
+import json
+from pathlib import Path
 import numpy as np
-import spectacle
+from . import instrumentation, stackfile
 
 
 def generate_mask(image, saturation_threshold=65000):
@@ -13,33 +15,379 @@ def generate_mask(image, saturation_threshold=65000):
     return where_saturated
 
 
-def load_image_blackfly(filename, dtype=np.uint16, shape=(2048, 2448), mask_saturated=False, saturation_threshold=65000):
+# Shape of a full frame, in pixels
+full_shape = (2048, 2448)
+
+# Bytes per pixel in each type of pixel format, by the end of the GenICam name (e.g. "Polarized12p" or "BayerRGPolarized16")
+bytes_per_pixel = {"16": 2, "12p": 1.5, "12Packed": 1.5}
+
+
+def _pixel_format_type(pixel_format):
+    """
+    Get the type of a GenICam pixel format name, i.e. the matching key of `bytes_per_pixel`.
+    """
+    for format_type in bytes_per_pixel:
+        if pixel_format.endswith(format_type):
+            return format_type
+    raise ValueError(f"Unknown pixel format '{pixel_format}'; the name should end in one of {list(bytes_per_pixel)}.")
+
+
+def describe_raw_file(filename, dtype=np.uint16, shape=None, pixel_format=None):
+    """
+    Determine the pixel format, shape, and position on the sensor (offset) of the image in a RAW file.
+    These are read from a sidecar file, if one exists: a JSON file with the same name as the image but a .json extension, containing the GenICam settings "PixelFormat", "Width", "Height", and optionally "OffsetX" and "OffsetY".
+    Otherwise, the pixel format and/or shape are determined from the file size, trying unpacked 16-bit pixels (`dtype`) and packed 12-bit pixels ("12p"). Images smaller than a full frame (region of interest) are assumed to be full-width.
+    `shape` and `pixel_format` can be given to skip detection.
+    Returns a dictionary with the "pixel_format", "shape", and "offset" (row, column).
+    """
+    filename = Path(filename)
+    offset = (0, 0)
+
+    # Read the sidecar, if there is one and nothing else was given
+    sidecar = filename.with_suffix(".json")
+    if shape is None and pixel_format is None and sidecar.exists():
+        with open(sidecar) as file:
+            settings = json.load(file)
+        shape = (settings["Height"], settings["Width"])
+        pixel_format = settings["PixelFormat"]
+        offset = (settings.get("OffsetY", 0), settings.get("OffsetX", 0))
+
+    # Candidate pixel formats and the number of bytes per pixel in each
+    if pixel_format is None:
+        candidates = {"16": np.dtype(dtype).itemsize, "12p": bytes_per_pixel["12p"]}
+    else:
+        format_type = _pixel_format_type(pixel_format)
+        candidates = {pixel_format: np.dtype(dtype).itemsize if format_type == "16" else bytes_per_pixel[format_type]}
+
+    # Find the pixel format (and number of rows) that match the file size
+    size = filename.stat().st_size
+    if shape is not None:
+        matches = [(name, tuple(shape)) for name, nbytes in candidates.items() if size == np.prod(shape) * nbytes]
+    else:
+        matches = [(name, full_shape) for name, nbytes in candidates.items() if size == np.prod(full_shape) * nbytes]
+        if not matches:
+            matches = [(name, (int(size // (full_shape[1] * nbytes)), full_shape[1])) for name, nbytes in candidates.items() if size % (full_shape[1] * nbytes) == 0]
+
+    if len(matches) != 1:
+        raise ValueError(f"Could not determine the pixel format and shape of {filename} ({size} bytes) unambiguously; found {matches}. Please provide them, e.g. in a sidecar file ({sidecar.name}).")
+
+    pixel_format, shape = matches[0]
+    return {"pixel_format": pixel_format, "shape": shape, "offset": offset}
+
+
+def _sensor_region(layout):
+    """
+    Get the index of an image on the full sensor, e.g. to crop a calibration, from its `layout` (see `describe_raw_file`).
+    """
+    return tuple(slice(start, start+length) for start, length in zip(layout["offset"], layout["shape"]))
+
+
+def unpack_12bit(packed, width, packing="12p", scale=True):
+    """
+    Unpack rows of packed 12-bit pixels (uint8, 3 bytes per 2 pixels) into uint16, in a few vectorised operations.
+    `packing` is "12p" (GenICam PFNC, e.g. Polarized12p: the lowest bits come first) or "12Packed" (older GigE Vision format: the highest 8 bits of each pixel come first).
+    If `scale` is True, the values are multiplied by 16, to the same range as 16-bit images from the camera, so the rest of the processing (e.g. the saturation threshold) does not change.
+    """
+    packed = np.asarray(packed, dtype=np.uint8).reshape(-1, width // 2, 3)
+    b0, b1, b2 = (packed[..., i].astype(np.uint16) for i in range(3))
+    unpacked = np.empty((packed.shape[0], width // 2, 2), dtype=np.uint16)
+
+    # Combine the three bytes into two pixels, shifted to 16 bits
+    if packing == "12p":
+        np.bitwise_or(b0 << 4, (b1 & 0x0F) << 12, out=unpacked[..., 0])
+        np.bitwise_or(b1 & 0xF0, b2 << 8, out=unpacked[..., 1])
+    elif packing == "12Packed":
+        np.bitwise_or(b0 << 8, (b1 & 0x0F) << 4, out=unpacked[..., 0])
+        np.bitwise_or(b2 << 8, b1 & 0xF0, out=unpacked[..., 1])
+    else:
+        raise ValueError(f"Unknown packing '{packing}'; use '12p' or '12Packed'.")
+
+    # Shift back to 12 bits if desired
+    if not scale:
+        unpacked >>= 4
+
+    return unpacked.reshape(-1, width)
+
+
+def pack_12bit(img, packing="12p"):
+    """
+    Pack a 16-bit image from the camera (12-bit values multiplied by 16) into packed 12-bit pixels, the inverse of `unpack_12bit`, e.g. to store existing data in 25% less space.
+    Raises a ValueError if any values have data in the lowest 4 bits, which would be lost.
+    """
+    img = np.asarray(img, dtype=np.uint16)
+    if np.any(img & 0x0F):
+        raise ValueError("The image contains values that are not multiples of 16, which cannot be stored in 12 bits without losing data.")
+
+    pairs = (img >> 4).reshape(-1, 2)
+    p0, p1 = pairs[:, 0], pairs[:, 1]
+    if packing == "12p":
+        packed = [p0 & 0xFF, (p0 >> 8) | ((p1 & 0x0F) << 4), p1 >> 4]
+    elif packing == "12Packed":
+        packed = [p0 >> 4, (p0 & 0x0F) | ((p1 & 0x0F) << 4), p1 >> 4]
+    else:
+        raise ValueError(f"Unknown packing '{packing}'; use '12p' or '12Packed'.")
+
+    return np.stack(packed, axis=-1).astype(np.uint8).ravel()
+
+
+class PackedImage:
+    """
+    Read-only packed 12-bit image file, which behaves like a memory-mapped uint16 array.
+    Only the rows that are indexed are read and unpacked (see `unpack_12bit`), e.g. `img[500:600]` reads 100 rows.
+    """
+    dtype = np.dtype(np.uint16)
+
+    def __init__(self, filename, shape, packing="12p", scale=True):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.packing = packing
+        self.scale = scale
+        self._bytes = np.memmap(filename, dtype=np.uint8, mode="r", shape=(self.shape[0], self.shape[1] * 3 // 2))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.filename}, shape={self.shape}, packing={self.packing})"
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        # Size on disk
+        return self._bytes.nbytes
+
+    def __getitem__(self, key):
+        # Unpack the rows that contain the region, then select the region within them
+        box, remaining = stackfile._bounding_box(key, self.shape)
+        if box is None:
+            return self[...][key]
+        rows = unpack_12bit(self._bytes[box[0]], self.shape[1], packing=self.packing, scale=self.scale)
+        return rows[:, box[1]][remaining]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+
+def _open_raw(filename, layout, dtype=np.uint16):
+    """
+    Open a RAW file with a known `layout` (see `describe_raw_file`) as a memory map or `PackedImage`.
+    """
+    format_type = _pixel_format_type(layout["pixel_format"])
+    if format_type == "16":
+        return np.memmap(filename, dtype=dtype, mode="r", shape=layout["shape"])
+    return PackedImage(filename, layout["shape"], packing=format_type)
+
+
+def open_image_blackfly(filename, dtype=np.uint16, shape=None, pixel_format=None):
+    """
+    Open an image from one of the blackfly polarisation cameras, as a read-only memory map (16-bit pixels) or `PackedImage` (packed 12-bit pixels, scaled to 16 bits).
+    No data are read from disk until the returned array is indexed, so slicing a region only reads the bytes it needs.
+    The pixel format and shape are detected if they are not given (see `describe_raw_file`).
+    """
+    layout = describe_raw_file(filename, dtype=dtype, shape=shape, pixel_format=pixel_format)
+    img = _open_raw(filename, layout, dtype=dtype)
+    return img
+
+
+@instrumentation.instrumented
+def load_image_blackfly(filename, dtype=np.uint16, shape=None, mask_saturated=False, saturation_threshold=65000, calibration=None, pixel_format=None):
     """
     Load an image from one of the blackfly polarisation cameras.
     Returns a numpy array containing the image data.
+    The pixel format (16-bit or packed 12-bit) and shape (full frame or region of interest) are detected if they are not given (see `describe_raw_file`).
+    Packed 12-bit images are scaled to the same range as 16-bit images.
     Saturated pixels are masked if `mask_saturated` is True.
+    If a `calibration` (see `fpc.calibration.Calibration`) is given, it is applied while loading and the image is returned as float32. Saturation is determined from the RAW values.
     """
-    # Load the image
-    img = np.fromfile(filename, dtype=dtype).reshape(shape)
+    # Open the image
+    layout = describe_raw_file(filename, dtype=dtype, shape=shape, pixel_format=pixel_format)
+    img_raw = _open_raw(filename, layout, dtype=dtype)
+    instrumentation.count_bytes_read(img_raw.nbytes)
+
+    # Packed images are unpacked into memory; memory maps are read directly into the result
+    packed = isinstance(img_raw, PackedImage)
+    if packed:
+        img_raw = img_raw[...]
+
+    # Load the image, calibrating it if desired
+    if calibration is not None:
+        img = calibration.crop(_sensor_region(layout)).apply(img_raw)
+    else:
+        img = img_raw if packed else np.array(img_raw)
 
     # Mask the image if desired
     if mask_saturated:
-        mask = generate_mask(img, saturation_threshold=saturation_threshold)
-        img = np.ma.MaskedArray(data=img, mask=mask)
+        mask = generate_mask(img_raw, saturation_threshold=saturation_threshold)
+        img = np.ma.MaskedArray(data=img, mask=np.asarray(mask), copy=False)
     return img
 
 
-def load_image_blackfly_multi(filenames, dtype=np.uint16, shape=(2048, 2448), mask_saturated=False):
+class FrameStack:
+    """
+    Lazy stack of images from one of the blackfly polarisation cameras.
+    Behaves like a read-only array of shape (N, *shape), but frames are only read from disk when they are indexed.
+    For example, `frames[:, 700, 700]` reads a single pixel from each file and `frames[i, 500:600, :]` reads 100 rows of one file.
+    The pixel format and shape are detected if they are not given (see `describe_raw_file`); all frames must have the same shape.
+    Saturated pixels are masked if `mask_saturated` is True.
+    If a `calibration` (see `fpc.calibration.Calibration`) is given, it is applied to every frame or region that is read, and the data are float32.
+    """
+    def __init__(self, filenames, dtype=np.uint16, shape=None, mask_saturated=False, saturation_threshold=65000, calibration=None, pixel_format=None):
+        self.filenames = list(filenames)
+        self.raw_dtype = np.dtype(dtype)
+        self.dtype = self.raw_dtype if calibration is None else np.dtype(np.float32)
+        self.pixel_format = pixel_format
+        self._shape = shape
+
+        # Determine the shape of the frames from the first file, if not given
+        if shape is None and len(self.filenames) > 0:
+            shape = describe_raw_file(self.filenames[0], dtype=dtype, pixel_format=pixel_format)["shape"]
+        self.frame_shape = tuple(shape) if shape is not None else full_shape
+        self.mask_saturated = mask_saturated
+        self.saturation_threshold = saturation_threshold
+        self.calibration = calibration
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} frames of {self.frame_shape}, dtype={self.dtype})"
+
+    def __len__(self):
+        return len(self.filenames)
+
+    @property
+    def shape(self):
+        return (len(self), *self.frame_shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return len(self) * int(np.prod(self.frame_shape)) * self.dtype.itemsize
+
+    def _read(self, index, region=(), out=None, mask_out=None):
+        """
+        Read `region` of frame number `index` into memory, or into `out` if given, calibrating it if desired.
+        If `mask_out` is given, the saturation mask is written into it.
+        """
+        layout = describe_raw_file(self.filenames[index], dtype=self.raw_dtype, shape=self._shape, pixel_format=self.pixel_format)
+        if layout["shape"] != self.frame_shape:
+            raise ValueError(f"Frame {self.filenames[index]} has shape {layout['shape']}, different from the first frame {self.frame_shape}.")
+        img_raw = _open_raw(self.filenames[index], layout, dtype=self.raw_dtype)
+        img = img_raw[region]
+        instrumentation.count_bytes_read(int(img.size * img_raw.nbytes / np.prod(self.frame_shape)))
+        if mask_out is not None:
+            np.greater(img, self.saturation_threshold, out=mask_out)
+
+        if self.calibration is not None:
+            data = self.calibration.crop(_sensor_region(layout)).apply(img, region=region, out=out)
+        elif out is not None:
+            out[...] = img
+            data = out
+        else:
+            data = np.array(img)
+        return data
+
+    def _region_shape(self, region):
+        """
+        Determine the shape of `region` within a single frame, without reading anything.
+        """
+        dummy = np.broadcast_to(np.zeros(1, dtype=self.dtype), self.frame_shape)
+        return dummy[region].shape
+
+    def _apply_mask(self, data, mask):
+        """
+        Mask saturated pixels in `data` if desired. The data are not copied.
+        """
+        if self.mask_saturated:
+            data = np.ma.MaskedArray(data=data, mask=mask, copy=False)
+        return data
+
+    @instrumentation.instrumented(stage_name="io.FrameStack")
+    def __getitem__(self, key):
+        # Split the key into a frame index and a region within each frame
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 0 and key[0] is Ellipsis:
+            key = (slice(None),) + key
+        frame_key, region = (key[0], key[1:]) if len(key) > 0 else (slice(None), ())
+
+        # Read each region directly into a pre-allocated array (and mask)
+        indices = np.arange(len(self))[frame_key]
+        region_shape = self._region_shape(region)
+        data = np.empty((*np.shape(indices), *region_shape), dtype=self.dtype)
+        mask = np.empty(data.shape, dtype=bool) if self.mask_saturated else None
+        for j, index in enumerate(np.atleast_1d(indices)):
+            j = (j, ...) if np.ndim(indices) else ...  # Views, also for single pixels
+            self._read(int(index), region, out=data[j], mask_out=mask[j] if mask is not None else None)
+
+        return self._apply_mask(data, mask)
+
+    def __iter__(self):
+        for j in range(len(self)):
+            yield self[j]
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asarray(self[:])
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+
+@instrumentation.instrumented
+def load_image_blackfly_multi(filenames, dtype=np.uint16, shape=None, mask_saturated=False, saturation_threshold=65000, calibration=None, pixel_format=None):
     """
     Load multiple images from one of the blackfly polarisation cameras.
-    Simply loops over the filenames, loads each, and stacks them in an array.
-    Masking to be implemented.
+    Returns a numpy array with shape (N, *shape) containing the image data.
+    The pixel format and shape are detected if they are not given (see `describe_raw_file`).
+    Saturated pixels are masked if `mask_saturated` is True.
+    If a `calibration` (see `fpc.calibration.Calibration`) is given, it is applied to each image while loading and the data are float32.
+    Use `FrameStack` instead to read frames or regions lazily.
+    """
+    frames = FrameStack(filenames, dtype=dtype, shape=shape, pixel_format=pixel_format, mask_saturated=mask_saturated, saturation_threshold=saturation_threshold, calibration=calibration)
+    data = frames[:]
+    return data
+
+
+def find_stacks(folder, name="mean"):
+    """
+    Find the stacks in `folder`, in sorted order.
+    Both stack files (`*.fpcstack`, see `fpc.stackfile`) and legacy pairs of NPY files (`*_mean.npy` and `*_stds.npy`) are found.
+    For legacy stacks, the `*_{name}.npy` file is returned. Either type of filename can be passed to `open_stack` and to `spectacle.linearity.filename_to_intensity`.
+    A stack that exists in both formats (e.g. `x.fpcstack` and `x_mean.npy`) is only returned once, as the stack file.
     """
-    # First, create an empty array with the appropriate shape
-    data = np.empty((len(filenames), *shape), dtype=dtype)
+    folder = Path(folder)
+    stacks = {filename.name[:-len(f"_{name}.npy")]: filename for filename in folder.glob(f"*_{name}.npy")}
+    stacks.update({filename.stem: filename for filename in folder.glob(f"*{stackfile.extension}")})
+    filenames = sorted(stacks.values())
+    return filenames
 
-    # Now load each image and put it into the array
-    for j, filename in enumerate(filenames):
-        data[j] = load_image_blackfly(filename, dtype=dtype, shape=shape)
 
+def open_stack(filename, name="mean", workers=1):
+    """
+    Open the `name` array (e.g. "mean" or "stds") of a stack lazily, so only the regions that are indexed are read from disk.
+    `filename` can be a stack file (see `fpc.stackfile`), whose chunks are decompressed using `workers` threads, or one of a legacy pair of NPY files (e.g. `x_mean.npy`, in which case `x_stds.npy` is opened for name="stds").
+    """
+    filename = Path(filename)
+
+    # Stack file
+    if filename.suffix == stackfile.extension:
+        return stackfile.StackFile(filename, workers=workers)[name]
+
+    # Legacy NPY file: swap the suffix if a different array is requested
+    stem = filename.stem.rsplit("_", 1)[0] if filename.stem.endswith(("_mean", "_stds")) else filename.stem
+    filename = filename.with_name(f"{stem}_{name}.npy")
+    return np.load(filename, mmap_mode="r")
+
+
+def load_stack(filename, name="mean", region=np.s_[...], workers=1):
+    """
+    Load a `region` of the `name` array of a stack into memory. See `open_stack`.
+    """
+    data = np.array(open_stack(filename, name=name, workers=workers)[region])
     return data
@@ -0,0 +1,102 @@
+"""
+Linearity of the camera response, calculated per pixel from stacks of mean images taken at different intensities.
+Stacks are opened lazily and processed in chunks of rows, so only a few rows of every stack are in memory at once.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from . import io
+
+# Names of the maps returned by `fit_linearity`
+map_names = ("r", "slope", "intercept", "residual", "nr_unsaturated")
+
+
+def response(filenames, region=np.s_[:], name="mean"):
+    """
+    Get the camera response in a `region` (e.g. `np.s_[700, 700]` for one pixel or `np.s_[500:600, 700:800]` for a region of interest) from a series of stacks.
+    `filenames` can be stack files or legacy NPY stacks (see `fpc.io.find_stacks`); `name` is the array to read, e.g. "mean" or "stds".
+    Only the bytes (or chunks) of `region` are read from each file.
+    Returns an array with shape (N, *region shape).
+    """
+    data = np.stack([io.load_stack(filename, name=name, region=region) for filename in filenames])
+    return data
+
+
+def _fit_rows(intensities, filenames, rows, saturation):
+    """
+    Fit a straight line to the response of every pixel in `rows` (a slice) as a function of `intensities`, ignoring values at or above `saturation`.
+    Returns the maps listed in `map_names` for these rows.
+    """
+    # Read these rows from each stack
+    y = response(filenames, np.s_[rows]).astype(np.float64)
+    x = np.asarray(intensities, dtype=np.float64).reshape(-1, *[1]*(y.ndim-1))
+
+    # Weight of each data point: 1 if unsaturated, 0 if saturated
+    weights = (y < saturation).astype(np.float64)
+    n = weights.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Centre the data on the mean of the unsaturated points in each pixel
+        x_mean = (weights * x).sum(axis=0) / n
+        y_mean = (weights * y).sum(axis=0) / n
+        dx = (x - x_mean) * weights
+        dy = (y - y_mean) * weights
+
+        # Least-squares fit and Pearson r from the (co)variances
+        Sxx = (dx * dx).sum(axis=0)
+        Syy = (dy * dy).sum(axis=0)
+        Sxy = (dx * dy).sum(axis=0)
+        slope = Sxy / Sxx
+        intercept = y_mean - slope * x_mean
+        r = Sxy / np.sqrt(Sxx * Syy)
+
+        # Root-mean-square residual of the unsaturated points around the fit
+        residuals = (y - (slope * x + intercept)) * weights
+        residual = np.sqrt((residuals**2).sum(axis=0) / n)
+
+    # A line cannot be fitted with fewer than two unsaturated points
+    too_few = (n < 2)
+    for arr in (r, slope, intercept, residual):
+        arr[too_few] = np.nan
+
+    return r, slope, intercept, residual, n.astype(np.int32)
+
+
+def _row_chunks(nr_rows, chunk_rows):
+    """
+    Split `nr_rows` rows into slices of at most `chunk_rows` rows.
+    """
+    return [slice(start, min(start+chunk_rows, nr_rows)) for start in range(0, nr_rows, chunk_rows)]
+
+
+def fit_linearity(intensities, filenames, saturation=0.95*(2**16 - 1), chunk_rows=128, workers=1):
+    """
+    Fit a straight line to the response of every pixel in a series of mean stacks (`filenames`, see `fpc.io.find_stacks`) as a function of `intensities`, in a single pass over the data.
+    Values at or above `saturation` are ignored, like in `spectacle.linearity.calculate_pearson_r_values`.
+    The stacks are processed in chunks of `chunk_rows` rows (by default, the height of the chunks in stack files), using `workers` processes in parallel.
+    Returns a dictionary with maps of the Pearson r, slope, intercept, root-mean-square residual, and number of unsaturated points (see `map_names`).
+    Pixels with fewer than two unsaturated points are NaN.
+    """
+    filenames = list(filenames)
+    if len(filenames) != len(intensities):
+        raise ValueError(f"Got {len(intensities)} intensities for {len(filenames)} stacks.")
+
+    # Determine the chunks from the shape of the first stack
+    shape = io.open_stack(filenames[0]).shape
+    chunks = _row_chunks(shape[0], chunk_rows)
+    maps = {name: np.empty(shape, dtype=np.int32 if name == "nr_unsaturated" else np.float64) for name in map_names}
+
+    def store(rows, results):
+        for name, result in zip(map_names, results):
+            maps[name][rows] = result
+
+    # Fit each chunk, in this process or in a pool of workers
+    if workers == 1:
+        for rows in chunks:
+            store(rows, _fit_rows(intensities, filenames, rows, saturation))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            nr_chunks = len(chunks)
+            all_results = executor.map(_fit_rows, [intensities]*nr_chunks, [filenames]*nr_chunks, chunks, [saturation]*nr_chunks)
+            for rows, results in zip(chunks, all_results):
+                store(rows, results)
+
+    return maps
@@ -0,0 +1,199 @@
+"""
+Live processing of RAW files while the camera is still writing them.
+
+A `LiveFeed` polls a folder for new files, waits until each file is complete (its size has stopped changing and matches a RAW image layout, see `fpc.io.describe_raw_file`), and passes it on, e.g. to `fpc.pipeline.run_pipeline`.
+Complete files are kept in a bounded backlog. If the processing cannot keep up with the camera, frames are dropped according to a policy, so the quick-looks stay close to real time and the memory use stays bounded.
+The time at which each file was written and detected is kept, so the latency of each frame can be reported (see `LiveFeed.latency`).
+
+Example:
+    feed = fpc.live.LiveFeed("data/", backlog=4, policy="subsample", idle_timeout=60)
+    for filename in fpc.pipeline.run_pipeline(feed, stages, stop=feed.stop):
+        print(filename, feed.latency(filename))
+"""
+import os
+import time
+from collections import deque
+from pathlib import Path
+from threading import Condition, Event, Thread
+from . import io
+
+# Ways of dropping frames when the backlog is full
+policies = ("oldest", "newest", "subsample")
+
+
+class LiveFeed:
+    """
+    Iterable over the new, complete files matching `pattern` in `folder`, in the order in which they are completed.
+    The folder is checked every `interval` seconds in a separate thread. A file is complete once its size has not changed for `settle` seconds and matches a RAW image layout (with the given `shape` and/or `pixel_format`, if any; see `fpc.io.describe_raw_file`).
+    Files that are already complete when the iteration starts are skipped, unless `existing` is True; files that are still being written are passed on once they are complete.
+
+    At most `backlog` complete files are waiting to be processed. When the backlog is full, frames are dropped according to `policy`:
+        * "oldest": drop the oldest waiting frame, so the newest frames are always processed.
+        * "newest": drop the new frame, so frames are processed in bursts.
+        * "subsample": drop every other waiting frame, so the remaining frames are spread evenly in time.
+    Dropped files are listed in `dropped`.
+
+    Iteration ends immediately when the `stop` event is set (e.g. by `fpc.pipeline.run_pipeline` when it stops), or after the backlog has been emptied when the feed is closed (see `close`) or no new files have been completed for `idle_timeout` seconds (if given).
+    """
+    def __init__(self, folder, pattern="*.raw", backlog=4, policy="oldest", interval=0.2, settle=0.5, idle_timeout=None, existing=False, shape=None, pixel_format=None):
+        if policy not in policies:
+            raise ValueError(f"Unknown policy `{policy}`; use one of {policies}.")
+        if backlog < 1:
+            raise ValueError(f"The backlog must hold at least one frame, not {backlog}.")
+
+        self.folder = Path(folder)
+        self.pattern = pattern
+        self.backlog = backlog
+        self.policy = policy
+        self.interval = interval
+        self.settle = settle
+        self.idle_timeout = idle_timeout
+        self.existing = existing
+        self.shape = shape
+        self.pixel_format = pixel_format
+
+        self.stop = Event()
+        self._closed = Event()
+        self.dropped = []
+        self.written = {}
+        self.detected = {}
+        self._waiting = deque()
+        self._condition = Condition()
+        self._finished = False
+
+    def __repr__(self):
+        return f"{type(self).__name__}({str(self.folder)!r}, backlog={self.backlog}, policy={self.policy!r})"
+
+    def close(self):
+        """
+        Stop watching the folder. The files that are still in the backlog are passed on before the iteration ends.
+        """
+        self._closed.set()
+
+    def _is_complete(self, filename, size):
+        """
+        Check if a file with a stable `size` contains a whole RAW image.
+        Files that have been renamed or deleted in the meantime are not complete.
+        """
+        if size == 0:
+            return False
+        try:
+            io.describe_raw_file(filename, shape=self.shape, pixel_format=self.pixel_format)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def _complete_files(self):
+        """
+        Find the files in the folder that already contain a whole RAW image (see `_is_complete`), with their sizes.
+        """
+        complete = {}
+        for filename in self.folder.glob(self.pattern):
+            try:
+                size = os.stat(filename).st_size
+            except OSError:
+                continue
+            if self._is_complete(filename, size):
+                complete[filename] = size
+        return complete
+
+    def _add(self, filename):
+        """
+        Add a complete file to the backlog, dropping frames if it is full.
+        """
+        with self._condition:
+            if len(self._waiting) >= self.backlog:
+                if self.policy == "oldest":
+                    self.dropped.append(self._waiting.popleft())
+                elif self.policy == "newest":
+                    self.dropped.append(filename)
+                    return
+                elif self.policy == "subsample":
+                    kept = list(self._waiting)[1::2]
+                    self.dropped.extend(list(self._waiting)[0::2])
+                    self._waiting = deque(kept)
+            self._waiting.append(filename)
+            self._condition.notify_all()
+
+    def _watch(self):
+        """
+        Poll the folder for new files until stopped, adding complete files to the backlog.
+        """
+        # Files that were already complete before watching started are skipped, unless `existing` is True; incomplete files are treated as new
+        # The sizes of the skipped files are checked for `settle` seconds, in case the camera was still writing them (filename: size)
+        start = time.monotonic()
+        initial = {} if self.existing else self._complete_files()
+        seen = set(initial)
+        growing = {}  # Files that are still being written (filename: (size, time the size last changed))
+        last_new = start
+
+        try:
+            while not self.stop.is_set() and not self._closed.is_set():
+                now = time.monotonic()
+
+                # Check the sizes of all new files
+                new_files = []
+                for filename in self.folder.glob(self.pattern):
+                    if filename in seen and filename not in initial:
+                        continue
+                    try:
+                        status = os.stat(filename)
+                    except FileNotFoundError:
+                        continue
+                    if filename in initial:
+                        if status.st_size == initial[filename]:
+                            continue
+                        # Still being written when watching started, so it is new after all
+                        seen.discard(filename)
+                        del initial[filename]
+                    size, changed = growing.get(filename, (None, now))
+                    if status.st_size != size:
+                        growing[filename] = (status.st_size, now)
+                    elif now - changed >= self.settle and self._is_complete(filename, size):
+                        new_files.append((status.st_mtime, filename))
+
+                # Pass complete files on, oldest first
+                for written, filename in sorted(new_files):
+                    seen.add(filename)
+                    del growing[filename]
+                    self.written[filename] = written
+                    self.detected[filename] = time.time()
+                    self._add(filename)
+                    last_new = now
+
+                # Files that have not changed since watching started were complete
+                if now - start >= self.settle:
+                    initial.clear()
+
+                # Stop if no new files have been completed for a while
+                if self.idle_timeout is not None and now - last_new > self.idle_timeout:
+                    break
+                self.stop.wait(self.interval)
+        finally:
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def __iter__(self):
+        watcher = Thread(target=self._watch, daemon=True)
+        watcher.start()
+
+        while True:
+            with self._condition:
+                # Wait for a file, or for the watcher to stop
+                while not self._waiting and not self._finished and not self.stop.is_set():
+                    self._condition.wait(timeout=self.interval)
+                if self.stop.is_set() or not self._waiting:
+                    break
+                filename = self._waiting.popleft()
+            yield filename
+
+        self.close()
+        watcher.join()
+
+    def latency(self, filename, now=None):
+        """
+        Get the time (in seconds) from when `filename` was last written by the camera to `now` (default: the current time), and from when it was detected to `now`.
+        """
+        now = time.time() if now is None else now
+        return now - self.written[filename], now - self.detected[filename]
@@ -0,0 +1,133 @@
+"""
+Pipelines for processing many images in parallel.
+Each stage of a pipeline runs on its own pool of workers, and the stages are connected by bounded queues.
+"""
+from collections import deque
+from queue import Queue, Full, Empty
+from threading import Thread, Event
+
+# Marker for the end of the input
+_end = object()
+
+
+class _Failure:
+    """
+    Wrapper for an exception raised in one of the stages, which is passed on to the end of the pipeline.
+    """
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _put(queue, item, stop):
+    """
+    Put `item` into `queue`, waiting while the queue is full, unless the pipeline is stopped.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Full:
+            continue
+
+
+def _get(queue, stop):
+    """
+    Get an item from `queue`, waiting while the queue is empty, unless the pipeline is stopped.
+    """
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Empty:
+            continue
+    return _end
+
+
+def _feed(items, queue_out, stop):
+    """
+    Put all `items` into the first queue of the pipeline.
+    """
+    try:
+        for item in items:
+            if stop.is_set():
+                return
+            _put(queue_out, item, stop)
+    except Exception as exception:
+        _put(queue_out, _Failure(exception), stop)
+    _put(queue_out, _end, stop)
+
+
+def _dispatch(function, executor, max_in_flight, queue_in, queue_out, stop):
+    """
+    Submit items from `queue_in` to `executor` and put the results into `queue_out`, in the same order.
+    At most `max_in_flight` items are processed at once; when `queue_out` is full, no new items are submitted.
+    """
+    in_flight = deque()
+
+    def collect_oldest():
+        future = in_flight.popleft()
+        try:
+            result = future.result()
+        except Exception as exception:
+            result = _Failure(exception)
+        _put(queue_out, result, stop)
+
+    try:
+        while not stop.is_set():
+            item = _get(queue_in, stop)
+            if item is _end:
+                break
+
+            # Pass failures from earlier stages on without processing them
+            if isinstance(item, _Failure):
+                _put(queue_out, item, stop)
+                continue
+
+            # Wait for the oldest item to finish if all workers are busy
+            if len(in_flight) >= max_in_flight:
+                collect_oldest()
+            in_flight.append(executor.submit(function, item))
+
+        # Finish the remaining items
+        while in_flight and not stop.is_set():
+            collect_oldest()
+    except Exception as exception:
+        # The executor cannot take any more work (e.g. a worker process died, or it was shut down): cancel the items in flight and pass the failure on
+        for future in in_flight:
+            future.cancel()
+        _put(queue_out, _Failure(exception), stop)
+    _put(queue_out, _end, stop)
+
+
+def run_pipeline(items, stages, backlog=4, stop=None):
+    """
+    Pass `items` through a sequence of `stages`, running each stage in parallel with the others.
+    Each stage is a tuple (function, executor, workers): `function` is applied to each output of the previous stage, using `executor` (e.g. a `concurrent.futures.ThreadPoolExecutor` or `ProcessPoolExecutor`) with at most `workers` items at once.
+    Between stages, at most `backlog` results are kept; if a later stage is slower than an earlier one, the earlier one waits (back-pressure), so memory use is bounded.
+    This is a generator that yields the results of the last stage, in the same order as `items`.
+    If any stage raises an exception, it is re-raised here and the pipeline is stopped.
+    The executors are not shut down.
+    `stop` is an optional `threading.Event` that is set when the pipeline stops, e.g. so that a generator of `items` that waits for new items (see `fpc.live.LiveFeed`) stops waiting. Setting it from elsewhere stops the pipeline early, discarding the items that are still being processed.
+    """
+    stop = stop if stop is not None else Event()
+    queues = [Queue(maxsize=backlog) for i in range(len(stages)+1)]
+
+    # Start a thread to feed the items in, and one thread per stage to dispatch work to its executor
+    threads = [Thread(target=_feed, args=(items, queues[0], stop), daemon=True)]
+    for (function, executor, workers), queue_in, queue_out in zip(stages, queues[:-1], queues[1:]):
+        threads.append(Thread(target=_dispatch, args=(function, executor, workers, queue_in, queue_out, stop), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    # Yield results from the last queue until the end marker arrives
+    try:
+        while True:
+            result = _get(queues[-1], stop)
+            if result is _end:
+                break
+            if isinstance(result, _Failure):
+                raise result.exception
+            yield result
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
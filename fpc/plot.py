@@ -7,9 +7,22 @@ from matplotlib.colors import LogNorm
 import spectacle
 from spectacle.plot import _saveshow
 from cmcrameri import cm as colourmaps
-from . import stokes
+from functools import wraps
+from . import instrumentation, statistics
 
-plt.rcParams['figure.dpi'] = 300
+# Matplotlib settings for all plots made here; these are only applied within the plotting functions
+style = {"figure.dpi": 300}
+
+
+def _styled(function):
+    """
+    Decorator to apply `style` while `function` is plotting, without changing the global matplotlib settings.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with plt.rc_context(style):
+            return function(*args, **kwargs)
+    return wrapper
 
 
 def convert_to_RGB_image(img, normalization=65535, gamma=2.4):
@@ -22,11 +35,13 @@ def convert_to_RGB_image(img, normalization=65535, gamma=2.4):
     return img_gamma
 
 
+@instrumentation.instrumented
+@_styled
 def show_image(data, lims=None, label="RAW Pixel value", ax=None, saveto=None, **kwargs):
     """
     Plot a RAW image from one of the polarisation cameras.
     `data` is the input array.
-    `lims` contains the min/max values of the colour bar. If None, these are estimated from percentiles.
+    `lims` contains the min/max values of the colour bar. If None, these are estimated from percentiles (see `fpc.statistics.percentile`).
     `saveto` is the destination. If None is given, only show the plot.
     **kwargs are passed to `plt.imshow`.
     """
@@ -38,7 +53,7 @@ def show_image(data, lims=None, label="RAW Pixel value", ax=None, saveto=None, *
 
     # Get limits for the colour bar
     if lims is None:
-        vmin, vmax = spectacle.symmetric_percentiles(data.ravel(), percent=0.5)
+        vmin, vmax = statistics.symmetric_percentiles(data, percent=0.5)
     else:
         vmin, vmax = lims
 
@@ -51,11 +66,14 @@ def show_image(data, lims=None, label="RAW Pixel value", ax=None, saveto=None, *
         _saveshow(saveto)
 
 
+@instrumentation.instrumented
+@_styled
 def show_histogram(data, bins=250, xlabel="", ax=None, saveto=None, **kwargs):
     """
     Plot a histogram for a data set.
     `data` is the input array.
     `bins` is the number of bins, or the bin edges, as passed to plt.hist.
+    The histogram is calculated with `fpc.statistics.histogram`, which is fast for RAW data. Masked pixels and NaNs are ignored.
     `saveto` is the destination. If None is given, only show the plot.
     **kwargs are passed to `plt.hist`
     """
@@ -65,8 +83,9 @@ def show_histogram(data, bins=250, xlabel="", ax=None, saveto=None, **kwargs):
         plt.figure(figsize=(3,3), tight_layout=True)
         ax = plt.gca()
 
-    # Plot histogram
-    _, bin_edges, _ = ax.hist(data.ravel(), bins=bins, **kwargs)
+    # Calculate the histogram, then plot the counts as weights on the bin edges
+    counts, bin_edges = statistics.histogram(data, bins=bins)
+    ax.hist(bin_edges[:-1], bins=bin_edges, weights=counts, **kwargs)
 
     # Plot settings
     ax.set_xlim(bin_edges[0], bin_edges[-1])
@@ -77,6 +96,8 @@ def show_histogram(data, bins=250, xlabel="", ax=None, saveto=None, **kwargs):
         _saveshow(saveto)
 
 
+@instrumentation.instrumented
+@_styled
 def show_testplot(data, lims=None, bins=250, label="RAW Pixel value", saveto=None):
     """
     Create a plot to show test results for a data set.
@@ -97,17 +118,14 @@ def show_testplot(data, lims=None, bins=250, label="RAW Pixel value", saveto=Non
 
 def symmetric_percentiles_maskedcompatible(data, **kwargs):
     """
-    Apply spectacle.symmetric_percentiles to masked or unmasked arrays.
-    Masked arrays are compressed first to ensure compatibility.
+    Calculate symmetric percentiles for masked or unmasked arrays.
+    This now simply calls `fpc.statistics.symmetric_percentiles`, which ignores masked pixels without copying the data.
     """
-    if isinstance(data, np.ma.MaskedArray):  # np.nanpercentile does not work well with masked arrays, they need to be compressed first
-        result = spectacle.symmetric_percentiles(data.compressed(), **kwargs)
-    else:
-        result = spectacle.symmetric_percentiles(data, **kwargs)
-
-    return result
+    return statistics.symmetric_percentiles(data, **kwargs)
 
 
+@instrumentation.instrumented
+@_styled
 def show_intensity_dolp_aolp(img_intensity, img_dolp, img_aolp, axs=None, intensity_lims=None, dolp_lims=(0, 0.2), aolp_lims=(0, 360), cmap_intensity=plt.cm.cividis, cmap_dolp=plt.cm.cividis, cmap_aolp=colourmaps.romaO, colorbar_location="bottom", saveto=None, **kwargs):
     """
     Plot the intensity, DoLP, and AoLP in a column of images.
@@ -146,6 +164,8 @@ def show_intensity_dolp_aolp(img_intensity, img_dolp, img_aolp, axs=None, intens
         _saveshow(saveto)
 
 
+@instrumentation.instrumented
+@_styled
 def show_intensity_dolp_aolp_RGB_separate(img_intensity_RGB, img_dolp_RGB, img_aolp_RGB, title="", saveto=None, **kwargs):
     """
     Plot the intensity, DoLP, and AoLP for an RGB image in three columns.
@@ -167,6 +187,8 @@ def show_intensity_dolp_aolp_RGB_separate(img_intensity_RGB, img_dolp_RGB, img_a
     _saveshow(saveto)
 
 
+@instrumentation.instrumented
+@_styled
 def show_intensity_dolp_aolp_RGB(img_intensity_RGB, img_dolp_RGB, img_aolp_RGB, title="", saveto=None, **kwargs):
     """
     Plot the intensity, DoLP, and AoLP for an RGB images in three colour panels.
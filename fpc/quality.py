@@ -0,0 +1,204 @@
+"""
+Quality index of RAW files: statistics per file, kept in a SQLite database next to the data, for selecting frames without reading them again.
+
+A folder is scanned once (see `index_folder`) and the minimum, maximum, and mean RAW value, the fraction of saturated pixels (above the threshold of `fpc.io.generate_mask`), and the time each file was written are saved per file.
+Files are sampled in whole 4x4 colour/polariser blocks, taking every `stride`-th block row and column, so every filter is sampled equally and only 1/`stride` of each file is read; `stride` = 1 reads everything and gives exact values.
+Files are described in parallel by a pool of worker processes. The index is updated incrementally: only new or changed files are read, and files that no longer exist are removed.
+
+Example:
+    index = fpc.quality.index_folder("data/", workers=4)
+    filenames = index.select(max_fraction_saturated=0, min_mean=2000)
+"""
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from . import io
+
+# Default name of the index database, in the folder it describes
+database_name = "fpc_quality.sqlite"
+
+# Columns of the index, and their SQLite types
+columns = {"name": "TEXT PRIMARY KEY", "size": "INTEGER", "mtime_ns": "INTEGER", "timestamp": "REAL",
+           "pixel_format": "TEXT", "height": "INTEGER", "width": "INTEGER", "stride": "INTEGER", "saturation_threshold": "INTEGER",
+           "nr_samples": "INTEGER", "min": "INTEGER", "max": "INTEGER", "mean": "REAL", "fraction_saturated": "REAL"}
+
+# Data types of the columns in `QualityIndex.table`
+table_dtype = np.dtype([("name", "U256"), ("size", np.int64), ("mtime_ns", np.int64), ("timestamp", np.float64),
+                        ("pixel_format", "U32"), ("height", np.int64), ("width", np.int64), ("stride", np.int64), ("saturation_threshold", np.int64),
+                        ("nr_samples", np.int64), ("min", np.int64), ("max", np.int64), ("mean", np.float64), ("fraction_saturated", np.float64)])
+
+# Number of files described between commits, so an interrupted scan keeps most of its progress
+commit_interval = 64
+
+
+def sample_image(img, stride=4):
+    """
+    Sample an opened RAW image (memory map or `fpc.io.PackedImage`, see `fpc.io.open_image_blackfly`) in whole 4x4 blocks, taking every `stride`-th block row and column.
+    Only the sampled rows are read from disk. Returns the sampled pixels as an array with dimensions [rows, columns].
+    """
+    height, width = img.shape
+    if height % 4 or width % 4:
+        raise ValueError(f"Image dimensions must be multiples of 4, not {img.shape}.")
+
+    rows = [img[start:start+4] for start in range(0, height, 4*stride)]
+    sample = np.concatenate(rows).reshape(-1, width//4, 4)[:, ::stride].reshape(len(rows)*4, -1)
+    return sample
+
+
+def describe_file(filename, stride=4, saturation_threshold=65000, pixel_format=None):
+    """
+    Describe a RAW file for the quality index: its size, modification time, layout (see `fpc.io.describe_raw_file`), and the statistics of a sample of its pixels (see `sample_image`).
+    Returns a dictionary with the `columns`.
+    """
+    filename = Path(filename)
+    status = filename.stat()
+    layout = io.describe_raw_file(filename, pixel_format=pixel_format)
+    sample = sample_image(io._open_raw(filename, layout), stride=stride)
+
+    description = {"name": filename.name, "size": status.st_size, "mtime_ns": status.st_mtime_ns, "timestamp": status.st_mtime,
+                   "pixel_format": layout["pixel_format"], "height": layout["shape"][0], "width": layout["shape"][1], "stride": stride, "saturation_threshold": saturation_threshold,
+                   "nr_samples": sample.size, "min": int(sample.min()), "max": int(sample.max()), "mean": float(sample.mean(dtype=np.float64)),
+                   "fraction_saturated": float(np.count_nonzero(io.generate_mask(sample, saturation_threshold=saturation_threshold)) / sample.size)}
+    return description
+
+
+def _describe_file(arguments):
+    """
+    Describe a file in a worker process, returning None instead of raising an error if it cannot be read (e.g. an incomplete file).
+    """
+    filename, kwargs = arguments
+    try:
+        return describe_file(filename, **kwargs)
+    except (OSError, ValueError):
+        return None
+
+
+class QualityIndex:
+    """
+    Quality index of the RAW files in `folder`, stored in a SQLite `database` (default: `database_name` in the folder).
+    Use `update` to (re-)index the files, and `select` or `table` to query it. The connection is closed by `close`, or when used as a context manager.
+    """
+    def __init__(self, folder, database=None):
+        self.folder = Path(folder)
+        self.database = Path(database) if database is not None else self.folder / database_name
+        self.connection = sqlite3.connect(self.database)
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS files ({', '.join(f'{name} {sql_type}' for name, sql_type in columns.items())})")
+
+    def __repr__(self):
+        return f"{type(self).__name__}({str(self.folder)!r}, {len(self)} files)"
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def outdated(self, filenames, stride=4, saturation_threshold=65000):
+        """
+        Find the files among `filenames` that are not in the index, have changed (size or modification time) since they were indexed, or were indexed with different settings.
+        Files that no longer exist (e.g. deleted or renamed since they were found) are skipped.
+        """
+        indexed = {name: tuple(values) for name, *values in self.connection.execute("SELECT name, size, mtime_ns, stride, saturation_threshold FROM files")}
+        outdated = []
+        for filename in filenames:
+            try:
+                status = filename.stat()
+            except OSError:
+                continue
+            if indexed.get(filename.name) != (status.st_size, status.st_mtime_ns, stride, saturation_threshold):
+                outdated.append(filename)
+        return outdated
+
+    def update(self, pattern="*.raw", workers=1, stride=4, saturation_threshold=65000, pixel_format=None):
+        """
+        Index the files matching `pattern` in the folder that are new or have changed (see `outdated`), using `workers` processes, and remove files that no longer exist.
+        Files that cannot be read (e.g. because they are still being written) are skipped, and tried again on the next update.
+        Returns the number of files that were (re-)indexed.
+        """
+        filenames = sorted(self.folder.glob(pattern))
+
+        # Remove files that no longer exist
+        names = {filename.name for filename in filenames}
+        with self.connection:
+            self.connection.executemany("DELETE FROM files WHERE name = ?", [(name,) for name, in self.connection.execute("SELECT name FROM files") if name not in names])
+
+        # Describe the new and changed files, in this process or in a pool of workers
+        kwargs = {"stride": stride, "saturation_threshold": saturation_threshold, "pixel_format": pixel_format}
+        tasks = [(filename, kwargs) for filename in self.outdated(filenames, stride=stride, saturation_threshold=saturation_threshold)]
+        executor = None
+        nr_indexed = 0
+        try:
+            if workers == 1:
+                results = map(_describe_file, tasks)
+            else:
+                executor = ProcessPoolExecutor(max_workers=workers)
+                results = executor.map(_describe_file, tasks, chunksize=4)
+
+            # Save the descriptions as they come in, committing regularly
+            statement = f"INSERT OR REPLACE INTO files ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            for description in results:
+                if description is None:
+                    continue
+                self.connection.execute(statement, tuple(description[column] for column in columns))
+                nr_indexed += 1
+                if nr_indexed % commit_interval == 0:
+                    self.connection.commit()
+        finally:
+            self.connection.commit()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        return nr_indexed
+
+    def _where(self, where=None, **limits):
+        """
+        Build an SQL WHERE clause and its parameters from a clause `where` and `limits` such as min_mean=2000 or max_fraction_saturated=0 (inclusive).
+        """
+        clauses, parameters = [], []
+        for key, value in limits.items():
+            bound, _, column = key.partition("_")
+            if bound not in ("min", "max") or column not in columns:
+                raise ValueError(f"Unknown limit `{key}`; use min_<column> or max_<column>, with a column from {list(columns)}.")
+            if value is not None:
+                clauses.append(f"{column} {'>=' if bound == 'min' else '<='} ?")
+                parameters.append(value)
+        if where is not None:
+            clauses.append(f"({where})")
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), parameters
+
+    def select(self, where=None, order_by="name", **limits):
+        """
+        Select the files that are within the given `limits` (e.g. min_mean=2000, max_fraction_saturated=0), and match an optional SQL clause `where` (e.g. "max < 60000").
+        Returns the full paths of the selected files, sorted by `order_by` (a column name, e.g. "timestamp").
+        """
+        if order_by not in columns:
+            raise ValueError(f"Cannot sort by unknown column `{order_by}`; use one of {list(columns)}.")
+        clause, parameters = self._where(where, **limits)
+        names = self.connection.execute(f"SELECT name FROM files{clause} ORDER BY {order_by}", parameters)
+        return [self.folder / name for name, in names]
+
+    def table(self, where=None, **limits):
+        """
+        Get the index, or the files selected by `where` and `limits` (see `select`), as a structured array with the `columns`, sorted by name.
+        """
+        clause, parameters = self._where(where, **limits)
+        rows = self.connection.execute(f"SELECT {', '.join(columns)} FROM files{clause} ORDER BY name", parameters).fetchall()
+        return np.array(rows, dtype=table_dtype)
+
+
+def index_folder(folder, pattern="*.raw", workers=1, stride=4, saturation_threshold=65000, pixel_format=None, database=None):
+    """
+    Open the quality index of `folder` and bring it up to date (see `QualityIndex.update`).
+    Returns the `QualityIndex`.
+    """
+    index = QualityIndex(folder, database=database)
+    index.update(pattern=pattern, workers=workers, stride=stride, saturation_threshold=saturation_threshold, pixel_format=pixel_format)
+    return index
@@ -0,0 +1,257 @@
+"""
+Chunked, compressed container for stacks (e.g. mean and standard deviation images).
+
+A stack file holds one or more named arrays and a dictionary of metadata (e.g. exposure time, number of frames, source files).
+Each array is split into tiles (chunks), which are compressed separately with zlib, so a region can be read without decompressing the rest of the array, and chunks can be decompressed in parallel.
+Before compression, the bytes of each chunk are shuffled (all first bytes of each value, then all second bytes, and so on), which compresses floating-point data much better. Compression is lossless.
+
+File layout:
+    * `magic` (8 bytes)
+    * compressed chunks, one after another
+    * header: JSON, describing the metadata, arrays, and offset and length of every chunk
+    * length of the header (8 bytes, little-endian unsigned integer), followed by `magic` again
+"""
+import json
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from pathlib import Path
+import numpy as np
+
+# File extension and identifier
+extension = ".fpcstack"
+magic = b"FPCSTK\x00\x01"
+
+# Default size of the chunks along the last two axes; this divides a full (2048, 2448) image into 16x4 chunks
+default_chunk_shape = (128, 612)
+
+
+def _shuffle(data):
+    """
+    Reorder the bytes of `data` so that the n-th bytes of all values are next to each other.
+    """
+    return np.ascontiguousarray(data).view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(buffer, dtype, shape):
+    """
+    Undo `_shuffle`, returning an array with the given `dtype` and `shape`.
+    """
+    dtype = np.dtype(dtype)
+    data = np.frombuffer(buffer, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy()
+    return data.view(dtype).reshape(shape)
+
+
+def _chunk_slices(shape, chunk_shape):
+    """
+    Get the slices for every chunk of an array with `shape`, in C order.
+    """
+    ranges = [range(0, length, step) for length, step in zip(shape, chunk_shape)]
+    return [tuple(slice(start, min(start+step, length)) for start, step, length in zip(starts, chunk_shape, shape)) for starts in product(*ranges)]
+
+
+def _full_chunk_shape(chunk_shape, ndim):
+    """
+    Extend `chunk_shape` to `ndim` axes; leading axes that are not given are chunked one element at a time.
+    Scalars (0-d arrays) are a single chunk.
+    """
+    if ndim == 0:
+        return ()
+    chunk_shape = tuple(chunk_shape)[-ndim:]
+    return (1,) * (ndim - len(chunk_shape)) + chunk_shape
+
+
+def save_stack(filename, arrays, metadata=None, chunk_shape=default_chunk_shape, compression=1, workers=1):
+    """
+    Save named `arrays` (a dictionary, e.g. {"mean": mean, "stds": stds}) to a stack file, with an optional dictionary of `metadata` (which must be JSON-compatible).
+    Arrays are split into chunks of `chunk_shape` (applied to the last axes) and compressed with zlib at level `compression` (0-9; higher levels are much slower and barely smaller for noisy data), using `workers` threads.
+    The file is first written under a temporary name, so an interrupted write never leaves an incomplete stack file.
+    """
+    filename = Path(filename)
+    header = {"metadata": metadata if metadata is not None else {}, "arrays": {}}
+
+    # Write to a temporary file first
+    temporary = filename.with_name(filename.name + ".tmp")
+    with open(temporary, "wb") as file, ThreadPoolExecutor(max_workers=workers) as executor:
+        file.write(magic)
+        offset = len(magic)
+
+        for name, data in arrays.items():
+            data = np.asarray(data)
+            chunks_here = _full_chunk_shape(chunk_shape, data.ndim)
+            slices = _chunk_slices(data.shape, chunks_here)
+
+            # Compress the chunks in parallel and write them in order
+            index = []
+            for compressed in executor.map(lambda region: zlib.compress(_shuffle(data[region]), compression), slices):
+                file.write(compressed)
+                index.append([offset, len(compressed)])
+                offset += len(compressed)
+
+            header["arrays"][name] = {"dtype": data.dtype.str, "shape": list(data.shape), "chunk_shape": list(chunks_here), "chunks": index}
+
+        # Write the header and the trailer
+        header_bytes = json.dumps(header).encode("utf-8")
+        file.write(header_bytes)
+        file.write(struct.pack("<Q", len(header_bytes)) + magic)
+
+    temporary.replace(filename)
+
+
+def _bounding_box(key, shape):
+    """
+    Split a basic index `key` (integers, slices, and Ellipsis) into the smallest box that contains it, and the index within that box.
+    Returns the box as a tuple of slices (step 1), and the remaining index, or None if `key` contains other (advanced) indices.
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    # Expand the Ellipsis, and add full slices for any missing axes
+    if any(k is Ellipsis for k in key):
+        position = [k is Ellipsis for k in key].index(True)
+        key = key[:position] + (slice(None),) * (len(shape) - len(key) + 1) + key[position+1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+    if len(key) != len(shape):
+        raise IndexError(f"Too many indices for an array with {len(shape)} dimensions.")
+
+    box, remaining = [], []
+    for k, length in zip(key, shape):
+        if isinstance(k, (int, np.integer)):
+            k = int(k) + length if k < 0 else int(k)
+            if not 0 <= k < length:
+                raise IndexError(f"Index {k} is out of bounds for an axis with size {length}.")
+            box.append(slice(k, k+1))
+            remaining.append(0)
+        elif isinstance(k, slice):
+            indices = range(*k.indices(length))
+            if len(indices) == 0:
+                box.append(slice(0, 0))
+                remaining.append(slice(0, 0))
+            else:
+                low, high = min(indices[0], indices[-1]), max(indices[0], indices[-1]) + 1
+                box.append(slice(low, high))
+                remaining.append(slice(indices[0] - low, None, indices.step))
+        else:
+            return None, None
+
+    return tuple(box), tuple(remaining)
+
+
+class StackArray:
+    """
+    One array in a stack file.
+    Behaves like a read-only array, but chunks are only read and decompressed when they are indexed.
+    For example, `array[500:600, 700:800]` only decompresses the chunks that overlap with that region.
+    """
+    def __init__(self, filename, name, description, workers=1):
+        self.filename = filename
+        self.name = name
+        self.dtype = np.dtype(description["dtype"])
+        self.shape = tuple(description["shape"])
+        self.chunk_shape = tuple(description["chunk_shape"])
+        self.chunks = description["chunks"]
+        self.workers = workers
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r} in {self.filename}, shape={self.shape}, dtype={self.dtype})"
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _read_box(self, box):
+        """
+        Read a box (tuple of slices with step 1) into memory, decompressing all chunks that overlap with it.
+        """
+        data = np.empty(tuple(b.stop - b.start for b in box), dtype=self.dtype)
+        if data.size == 0:
+            return data
+
+        # Find the chunks that overlap with the box
+        grid = [range(length // step + (length % step > 0)) for length, step in zip(self.shape, self.chunk_shape)]
+        chunk_ranges = [range(b.start // step, (b.stop - 1) // step + 1) for b, step in zip(box, self.chunk_shape)]
+        chunk_indices = list(product(*chunk_ranges))
+        flat_indices = [np.ravel_multi_index(index, [len(g) for g in grid]) for index in chunk_indices]
+
+        # Read the compressed chunks in file order
+        buffers = {}
+        with open(self.filename, "rb") as file:
+            for flat_index in sorted(flat_indices):
+                offset, length = self.chunks[flat_index]
+                file.seek(offset)
+                buffers[flat_index] = file.read(length)
+
+        # Decompress each chunk and copy the overlap with the box into the output
+        def decompress(index, flat_index):
+            chunk_region = tuple(slice(i*step, min((i+1)*step, length)) for i, step, length in zip(index, self.chunk_shape, self.shape))
+            chunk = _unshuffle(zlib.decompress(buffers[flat_index]), self.dtype, tuple(c.stop - c.start for c in chunk_region))
+            overlap = tuple(slice(max(c.start, b.start), min(c.stop, b.stop)) for c, b in zip(chunk_region, box))
+            data[tuple(slice(o.start - b.start, o.stop - b.start) for o, b in zip(overlap, box))] = chunk[tuple(slice(o.start - c.start, o.stop - c.start) for o, c in zip(overlap, chunk_region))]
+
+        if self.workers == 1:
+            for index, flat_index in zip(chunk_indices, flat_indices):
+                decompress(index, flat_index)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(decompress, chunk_indices, flat_indices))
+
+        return data
+
+    def __getitem__(self, key):
+        box, remaining = _bounding_box(key, self.shape)
+
+        # Advanced indexing: read everything, then let numpy do the indexing
+        if box is None:
+            return self[...][key]
+
+        data = self._read_box(box)
+        return data[remaining]
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asarray(self[...])  # Scalars (0-d arrays) are indexed into numpy scalars
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+
+class StackFile:
+    """
+    Stack file, opened for reading.
+    The `metadata` are available as a dictionary, and the arrays by name, e.g. `StackFile(filename)["mean"]`.
+    Arrays are read lazily (see `StackArray`), decompressing chunks with `workers` threads.
+    """
+    def __init__(self, filename, workers=1):
+        self.filename = Path(filename)
+        self.workers = workers
+
+        # Read the header from the end of the file
+        with open(self.filename, "rb") as file:
+            if file.read(len(magic)) != magic:
+                raise ValueError(f"{self.filename} is not a stack file.")
+            file.seek(-8-len(magic), 2)
+            header_length = struct.unpack("<Q", file.read(8))[0]
+            file.seek(-8-len(magic)-header_length, 2)
+            header = json.loads(file.read(header_length).decode("utf-8"))
+
+        self.metadata = header["metadata"]
+        self._arrays = header["arrays"]
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.filename}, arrays={list(self._arrays)})"
+
+    def keys(self):
+        return self._arrays.keys()
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def __getitem__(self, name):
+        return StackArray(self.filename, name, self._arrays[name], workers=self.workers)
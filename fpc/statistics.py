@@ -0,0 +1,207 @@
+"""
+Statistics for images and stacks of images from polarisation cameras.
+"""
+import numpy as np
+
+
+def mean_and_std(frames, dtype=np.float32):
+    """
+    Calculate the mean and standard deviation per pixel over a sequence of frames.
+    `frames` can be any re-iterable sequence of equally-shaped arrays, such as an `fpc.io.FrameStack`.
+    Frames are read one at a time in two passes (mean, then squared deviations), so memory use does not depend on the number of frames.
+    The accumulation order is the same as in numpy, so the results are identical to `arrs.mean(axis=0, dtype=dtype)` and `arrs.std(axis=0, dtype=dtype)` on the full stack.
+    """
+    # First pass: sum all frames
+    total = None
+    nr_frames = 0
+    for frame in frames:
+        if total is None:
+            total = np.zeros(frame.shape, dtype=dtype)
+        total += frame
+        nr_frames += 1
+
+    if nr_frames == 0:
+        raise ValueError("Cannot calculate the mean and standard deviation of an empty sequence of frames.")
+
+    # Calculate the mean per pixel, re-using the sum array
+    mean = np.true_divide(total, nr_frames, out=total)
+
+    # Second pass: sum the squared deviations from the mean, re-using a single buffer
+    deviation = np.empty_like(mean)
+    total_squares = np.zeros_like(mean)
+    for frame in frames:
+        np.subtract(frame, mean, out=deviation)
+        np.multiply(deviation, deviation, out=deviation)
+        total_squares += deviation
+
+    # Calculate the standard deviation per pixel, re-using the sum of squares array
+    variance = np.true_divide(total_squares, nr_frames, out=total_squares)
+    std = np.sqrt(variance, out=variance)
+
+    return mean, std
+
+
+def _unmasked_values(data):
+    """
+    Get the unmasked, non-NaN values in `data` as a flat array.
+    Unmasked data without NaNs (such as RAW images) are not copied.
+    """
+    values = np.ma.getdata(data).ravel()
+    bad = np.ma.getmaskarray(data).ravel() if isinstance(data, np.ma.MaskedArray) else None
+    if np.issubdtype(values.dtype, np.floating):
+        nan = np.isnan(values)
+        bad = nan if bad is None else (bad | nan)
+    if bad is not None and bad.any():
+        values = values[~bad]
+    return values
+
+
+def _is_small_unsigned_integer(data):
+    """
+    Check if `data` contain unsigned integers of at most 16 bits, which can be counted per value.
+    """
+    return np.issubdtype(data.dtype, np.unsignedinteger) and data.dtype.itemsize <= 2
+
+
+def count_values(data):
+    """
+    Count how often each value occurs in an image of unsigned integers (e.g. uint16 RAW data), in a single pass.
+    Masked pixels are ignored.
+    Returns an array with the count for every possible value (65536 for uint16).
+    """
+    if not _is_small_unsigned_integer(data):
+        raise TypeError(f"Values can only be counted for unsigned integers of up to 16 bits, not {data.dtype}.")
+
+    counts = np.bincount(np.ma.getdata(data).ravel(), minlength=np.iinfo(data.dtype).max+1)
+
+    # Remove masked pixels from the counts; there are usually few, so this is faster than selecting the unmasked pixels
+    if isinstance(data, np.ma.MaskedArray):
+        counts -= np.bincount(np.ma.getdata(data)[np.ma.getmaskarray(data)], minlength=len(counts))
+
+    return counts
+
+
+def _percentile_from_histogram(counts, bin_edges, percent, exact=False):
+    """
+    Calculate the `percent` percentile(s) from a histogram.
+    If `exact` is True, every bin is a single integer value (bin_edges[i]), and the result is identical to `np.percentile` on the original data.
+    Otherwise, values are assumed to be spread evenly within each bin, so the result is accurate to within one bin width.
+    """
+    cumulative_counts = np.cumsum(counts)
+    total = cumulative_counts[-1]
+    if total == 0:
+        return np.full(np.shape(percent), np.nan)
+
+    # Fractional rank of each percentile in the sorted data, as in np.percentile
+    rank = np.asarray(percent, dtype=np.float64) / 100 * (total - 1)
+
+    if exact:
+        # Interpolate linearly between the values at the neighbouring integer ranks
+        rank_low = np.floor(rank)
+        value_low = bin_edges[np.searchsorted(cumulative_counts, rank_low, side="right")]
+        value_high = bin_edges[np.searchsorted(cumulative_counts, np.minimum(rank_low + 1, total - 1), side="right")]
+        result = value_low + (rank - rank_low) * (value_high - value_low)
+    else:
+        # Interpolate linearly within the bin that contains each rank
+        index = np.searchsorted(cumulative_counts, rank, side="right")
+        count_before = np.where(index > 0, cumulative_counts[index-1], 0)
+        fraction = (rank - count_before + 0.5) / counts[index]
+        result = bin_edges[index] + np.clip(fraction, 0, 1) * (bin_edges[index+1] - bin_edges[index])
+
+    return result
+
+
+def percentile(data, percent, bins=65536):
+    """
+    Calculate the `percent` percentile(s) of `data` using a histogram, in linear time. Masked pixels and NaNs are ignored.
+    For unsigned integers of up to 16 bits (e.g. RAW data), the result is exact and identical to `np.nanpercentile`.
+    For other data, e.g. floating-point Stokes parameters, it is approximated using a histogram with `bins` bins between the minimum and maximum, which is accurate to within (max - min) / `bins`.
+    """
+    # Exact: count every possible value
+    if _is_small_unsigned_integer(data):
+        counts = count_values(data)
+        return _percentile_from_histogram(counts, np.arange(len(counts)), percent, exact=True)
+
+    # Approximate: use a histogram with evenly spaced bins between the minimum and maximum
+    values = _unmasked_values(data)
+    if len(values) == 0:
+        return np.full(np.shape(percent), np.nan)
+    low, high = values.min(), values.max()
+    if low == high:
+        return np.full(np.shape(percent), low, dtype=np.float64)
+
+    # Bin the values by scaling them to bin indices directly (float32 is precise enough for this), which is much faster than np.histogram for many bins
+    indices = np.subtract(values, low, dtype=np.float32)
+    indices *= bins / (high - low)
+    indices = indices.astype(np.intp)
+    np.minimum(indices, bins-1, out=indices)
+    counts = np.bincount(indices, minlength=bins)
+    bin_edges = np.linspace(low, high, bins+1)
+
+    return _percentile_from_histogram(counts, bin_edges, percent)
+
+
+def symmetric_percentiles(data, percent=0.1, **kwargs):
+    """
+    Find the lowest and highest `percent` percentile in a data set `data`, like `spectacle.symmetric_percentiles`, but in linear time (see `percentile`).
+    Default: P_0.1 and P_99.9
+    Additional **kwargs are passed to `percentile`.
+    """
+    low, high = percentile(data, [percent, 100-percent], **kwargs)
+    return low, high
+
+
+def histogram(data, bins=250):
+    """
+    Calculate the histogram of `data`, like `np.histogram`. Masked pixels and NaNs are ignored.
+    For unsigned integers of up to 16 bits (e.g. RAW data), the values are counted once (see `count_values`) and then summed into the bins, which is much faster than binning every pixel.
+    `bins` is the number of bins, or the bin edges.
+    Returns the counts and bin edges.
+    """
+    # Any other data: use numpy
+    if not _is_small_unsigned_integer(data):
+        return np.histogram(_unmasked_values(data), bins=bins)
+
+    # Determine the bin edges from the range of values, as numpy does
+    counts = count_values(data)
+    if np.ndim(bins) == 0:
+        occurring = np.flatnonzero(counts)
+        low, high = (occurring[0], occurring[-1]) if len(occurring) else (0, 1)
+        if low == high:
+            low, high = low - 0.5, high + 0.5
+        bins = np.linspace(low, high, bins+1)
+    bin_edges = np.asarray(bins, dtype=np.float64)
+
+    # Sum the counts in each bin, using the number of values below each bin edge; the last bin includes its right edge
+    cumulative_counts = np.concatenate([[0], np.cumsum(counts)])
+    below_edges = cumulative_counts[np.clip(np.ceil(bin_edges), 0, len(counts)).astype(np.intp)]
+    below_edges[-1] = cumulative_counts[np.clip(np.floor(bin_edges[-1]) + 1, 0, len(counts)).astype(np.intp)]
+    bin_counts = np.diff(below_edges)
+
+    return bin_counts, bin_edges
+
+
+def describe_raw(data, saturation_threshold=65000):
+    """
+    Summarise a RAW image (unsigned integers) in a single pass over the data.
+    Returns a dictionary with the number of pixels, the minimum, maximum, mean, median, 0.1 and 99.9 percentiles, and the number and fraction of saturated pixels (above `saturation_threshold`, as in `fpc.io.generate_mask`).
+    Masked pixels are ignored.
+    """
+    counts = count_values(data)
+    values = np.arange(len(counts))
+    total = counts.sum()
+    occurring = np.flatnonzero(counts)
+    saturated = counts[saturation_threshold+1:].sum()
+    P_low, median, P_high = _percentile_from_histogram(counts, values, [0.1, 50, 99.9], exact=True)
+
+    summary = {"nr_pixels": int(total),
+               "min": int(occurring[0]) if total else None,
+               "max": int(occurring[-1]) if total else None,
+               "mean": float(np.dot(counts, values) / total) if total else None,
+               "median": float(median),
+               "P_0.1": float(P_low),
+               "P_99.9": float(P_high),
+               "nr_saturated": int(saturated),
+               "fraction_saturated": float(saturated / total) if total else None}
+
+    return summary
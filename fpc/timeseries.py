@@ -0,0 +1,184 @@
+"""
+Time series of the polarisation in regions of interest (ROIs), such as a target panel or a patch of sky, across many frames.
+
+Only the rows and columns of each ROI, plus a margin for the demosaicking, are read from each RAW file, so extracting a time series is much faster than processing whole frames.
+Within the ROI, the Stokes parameters are identical to those of the whole frame (see `fpc.stokes.process_tiled`).
+For each frame, ROI, and colour channel, the mean Stokes parameters, the DoLP and AoLP of the mean Stokes vector, and the mean and standard deviation of the DoLP and AoLP per pixel are calculated.
+The AoLP is an axial angle (0 and 180 degrees are the same), so its mean and standard deviation are circular (see `circular_mean_and_std`).
+The results are written to a CSV table as they are calculated, one row per frame, ROI, and colour channel.
+
+Example:
+    rois = {"panel": np.s_[500:600, 700:800], "sky": np.s_[0:200, 1000:1400]}
+    table = fpc.timeseries.extract_timeseries(sorted(folder.glob("*.raw")), rois, saveto="timeseries.csv", workers=4)
+    G_panel = table[(table["roi"] == "panel") & (table["channel"] == "G")]
+"""
+import csv
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from . import io, stokes
+
+# Names of the colour channels, in the same order as in `fpc.stokes.raw_to_stokes`
+channels = ("R", "G", "B")
+
+# Columns of the table, and their data types
+columns = {"frame": np.int64, "filename": "U256", "roi": "U64", "channel": "U1", "nr_pixels": np.int64,
+           "I": np.float64, "Q": np.float64, "U": np.float64, "DoLP": np.float64, "AoLP": np.float64,
+           "DoLP_mean": np.float64, "DoLP_std": np.float64, "AoLP_mean": np.float64, "AoLP_std": np.float64}
+table_dtype = np.dtype(list(columns.items()))
+
+# Frames and ROI windows used by the current (worker) process, and a workspace per ROI
+_frames = None
+_windows = None
+_workspaces = {}
+
+
+def _window(region, shape, halo=stokes.tile_halo):
+    """
+    Determine which part of an image with the given `shape` must be read to demosaick a `region` (two slices) exactly: the region, extended to whole 4x4 colour/polariser blocks and a margin of `halo` pixels, within the image.
+    Returns the window (two slices) and the position of the region within the window (two slices).
+    """
+    if len(region) != 2 or not all(isinstance(index, slice) for index in region):
+        raise ValueError(f"An ROI must consist of two slices (e.g. np.s_[500:600, 700:800]), not {region}.")
+
+    window, region_in_window = [], []
+    for index, length in zip(region, shape):
+        start, stop, step = index.indices(length)
+        if step != 1 or stop <= start:
+            raise ValueError(f"ROI {region} is empty or has a step size; this is not supported.")
+        start_window = max(start // 4 * 4 - halo, 0)
+        stop_window = min(-(-stop // 4) * 4 + halo, length)
+        window.append(slice(start_window, stop_window))
+        region_in_window.append(slice(start - start_window, stop - start_window))
+
+    return tuple(window), tuple(region_in_window)
+
+
+def circular_mean_and_std(angles, period=180, axis=None):
+    """
+    Calculate the circular mean and standard deviation of `angles` (in degrees) with the given `period` (180 for the AoLP) along `axis`, ignoring NaNs.
+    The mean is between 0 and `period`; the standard deviation is sqrt(-2 ln R), with R the mean resultant length, converted to degrees.
+    The results are NaN if there are no valid angles.
+    """
+    angles = np.asarray(angles)
+    valid = np.isfinite(angles)
+    count = valid.sum(axis=axis)
+
+    # Map one period onto the full circle, and average the unit vectors
+    radians = np.where(valid, angles, 0) * (2 * np.pi / period)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        C = np.where(valid, np.cos(radians), 0).sum(axis=axis, dtype=np.float64) / count
+        S = np.where(valid, np.sin(radians), 0).sum(axis=axis, dtype=np.float64) / count
+        R = np.minimum(np.hypot(C, S), 1)
+
+        mean = np.arctan2(S, C) * (period / (2 * np.pi)) % period
+        std = np.sqrt(-2 * np.log(R)) * (period / (2 * np.pi))
+
+    # No valid angles
+    mean, std = np.where(count > 0, mean, np.nan), np.where(count > 0, std, np.nan)
+    return mean, std
+
+
+def roi_statistics(img_stokes):
+    """
+    Calculate the statistics of the Stokes parameters in an ROI, per colour channel.
+    `img_stokes` has dimensions [x, y, RGB, IQU] (see `fpc.stokes.raw_to_stokes`); pixels that are NaN in any Stokes parameter (e.g. saturated, see `mask_to_nan`) are ignored.
+    Returns a list with a dictionary of statistics (see `columns`) for each colour channel.
+    """
+    # Copy the data into one contiguous row of pixels per colour and Stokes parameter, so the sums below are fast
+    data = np.moveaxis(np.ma.getdata(img_stokes), (-2, -1), (0, 1)).reshape(3, 3, -1)
+    valid = np.isfinite(data[:, 0] + data[:, 1] + data[:, 2])
+    nr_pixels = valid.sum(axis=-1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Mean Stokes vector, and its DoLP and AoLP
+        mean_stokes = np.where(valid[:, np.newaxis], data, 0).sum(axis=-1, dtype=np.float64) / nr_pixels[:, np.newaxis]
+        mean_intensity, DoLP, AoLP = stokes.convert_stokes_to_lp(mean_stokes)
+
+        # Mean and standard deviation of the DoLP and AoLP per pixel
+        img_intensity, img_DoLP, img_AoLP = stokes.convert_stokes_to_lp(np.moveaxis(data, 1, -1))
+        img_DoLP = np.where(valid, img_DoLP, 0)
+        DoLP_mean = img_DoLP.sum(axis=-1, dtype=np.float64) / nr_pixels
+        DoLP_std = np.sqrt(np.maximum(np.square(img_DoLP).sum(axis=-1, dtype=np.float64) / nr_pixels - DoLP_mean**2, 0))
+        AoLP_mean, AoLP_std = circular_mean_and_std(np.where(valid, img_AoLP, np.nan), axis=-1)
+
+    statistics = [{"channel": name, "nr_pixels": int(nr_pixels[channel]), "I": mean_stokes[channel, 0], "Q": mean_stokes[channel, 1], "U": mean_stokes[channel, 2],
+                   "DoLP": DoLP[channel], "AoLP": AoLP[channel], "DoLP_mean": DoLP_mean[channel], "DoLP_std": DoLP_std[channel], "AoLP_mean": AoLP_mean[channel], "AoLP_std": AoLP_std[channel]}
+                  for channel, name in enumerate(channels)]
+    return statistics
+
+
+def _initialise(frames, windows):
+    """
+    Set the frames and ROI windows for this (worker) process.
+    """
+    global _frames, _windows
+    _frames, _windows = frames, windows
+    _workspaces.clear()
+
+
+def _frame_rows(index):
+    """
+    Read the ROIs from frame number `index` of the current frames (see `_initialise`) and calculate their statistics.
+    Returns a list of table rows (tuples, see `columns`).
+    """
+    rows = []
+    filename = str(_frames.filenames[index])
+    for name, (window, region_in_window) in _windows.items():
+        img = _frames[(index, *window)]
+        workspace = _workspaces.setdefault(name, stokes.Workspace())
+        img_stokes = stokes.raw_to_stokes(img, dtype=np.float32, mask_to_nan=True, workspace=workspace)[region_in_window]
+        for statistics in roi_statistics(img_stokes):
+            statistics.update(frame=index, filename=filename, roi=name)
+            rows.append(tuple(statistics[column] for column in columns))
+    return rows
+
+
+def extract_timeseries(filenames, rois, saveto=None, workers=1, mask_saturated=True, calibration=None, pixel_format=None):
+    """
+    Extract time series of the polarisation in `rois` (a dictionary of names and regions, e.g. {"panel": np.s_[500:600, 700:800]}) from a series of RAW files (`filenames`).
+    Only the ROIs, plus a margin for the demosaicking, are read from each file (see `fpc.io.FrameStack`), and saturated pixels are ignored if `mask_saturated` is True.
+    A `calibration` (see `fpc.calibration`) and `pixel_format` (see `fpc.io.describe_raw_file`) are passed on to the frame stack.
+    The frames are processed by `workers` processes in parallel.
+    If `saveto` is given, the results are written to a CSV file with the `columns` as they are calculated, so they are kept if the extraction is interrupted.
+    Returns a structured array with the `columns`, with one row per frame, ROI, and colour channel.
+    """
+    frames = io.FrameStack(filenames, mask_saturated=mask_saturated, calibration=calibration, pixel_format=pixel_format)
+    windows = {name: _window(region, frames.frame_shape) for name, region in rois.items()}
+    indices = range(len(frames))
+
+    # Open the output file, if any
+    file = open(saveto, "w", newline="") if saveto is not None else None
+    writer = csv.writer(file) if file is not None else None
+    if writer is not None:
+        writer.writerow(columns)
+
+    # Process the frames in this process or in a pool of workers, and write the results in order
+    rows = []
+    executor = None
+    try:
+        if workers == 1:
+            _initialise(frames, windows)
+            results = map(_frame_rows, indices)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_initialise, initargs=(frames, windows))
+            results = executor.map(_frame_rows, indices, chunksize=8)
+        for rows_frame in results:
+            rows.extend(rows_frame)
+            if writer is not None:
+                writer.writerows(rows_frame)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if file is not None:
+            file.close()
+
+    return np.array(rows, dtype=table_dtype)
+
+
+def read_table(filename):
+    """
+    Read a table saved by `extract_timeseries` into a structured array.
+    """
+    with open(filename, newline="") as file:
+        rows = [tuple(row[column] for column in columns) for row in csv.DictReader(file)]
+    return np.array(rows, dtype=table_dtype)
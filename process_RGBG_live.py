@@ -0,0 +1,89 @@
+"""
+Live data processing for images from the RGBG polarisation camera: quick-looks
+of the intensity, DoLP, and AoLP in the G channel are made while the camera is
+still writing RAW files into a folder.
+
+The folder is polled for new files, which are processed as soon as they are
+complete, using the same pipeline as process_RGBG_multiple.py. If the
+processing cannot keep up with the camera, at most `backlog` files are kept
+waiting and frames are dropped according to `policy` (see `fpc.live.LiveFeed`):
+`oldest` (default) always processes the newest frames, `newest` processes
+frames in bursts, and `subsample` spreads the processed frames evenly in time.
+The latency of each frame (from when it was written to when its quick-look was
+saved) is printed, and summarised at the end together with the dropped frames.
+
+Call signature:
+    python process_RGBG_live.py my_folder/ [workers] [backlog] [policy] [idle_timeout] [log] [resolution]
+
+`workers` is the number of compute and render workers each (default: number of
+CPUs). `idle_timeout` is the number of seconds without new files after which
+the processing stops (default: none, or `-`; stop with Ctrl+C). If `log` is
+given, the processing stages are recorded per file in this JSON-lines file
+(see `fpc.instrumentation`), and summarised at the end (use `-` to skip it).
+`resolution` is `full` (default), or `half` or `quarter` for quick-looks
+calculated per superpixel without interpolation, which is much faster (see
+`fpc.stokes.raw_to_stokes_superpixel`).
+"""
+from sys import argv
+from pathlib import Path
+from os import cpu_count
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import fpc
+from process_RGBG_multiple import load, compute, render_fast
+
+if __name__ == "__main__":
+    # Get the folder from the command line
+    data_folder = Path(argv[1])
+    print(f"Watching {data_folder.absolute()} for new data")
+
+    # Where to save the results
+    data_label = f"{data_folder.parent.stem}_{data_folder.stem}"
+    saveto = Path("E:/blackfly_processed/") / data_label
+    saveto.mkdir(parents=True, exist_ok=True)
+    print(f"Processed images will be saved in {saveto.absolute()}")
+
+    # Number of workers, backlog and overload policy, and log
+    workers = int(argv[2]) if len(argv) > 2 else cpu_count()
+    backlog = int(argv[3]) if len(argv) > 3 else workers
+    policy = argv[4] if len(argv) > 4 else "oldest"
+    idle_timeout = float(argv[5]) if len(argv) > 5 and argv[5] != "-" else None
+    log = Path(argv[6]) if len(argv) > 6 and argv[6] != "-" else None
+    resolution = argv[7] if len(argv) > 7 else "full"
+    print(f"Using {workers} compute threads and {workers} render threads at {resolution} resolution, with a backlog of {backlog} files (dropping: {policy}).")
+
+    # Record the processing stages if desired
+    if log is not None:
+        fpc.instrumentation.enable(saveto=log)
+        print(f"Processing stages will be recorded in {log.absolute()}")
+
+    # Run new files through the pipeline as they come in: read -> compute -> render
+    feed = fpc.live.LiveFeed(data_folder, backlog=backlog, policy=policy, idle_timeout=idle_timeout)
+    latencies = []
+    print("\nNow processing (latency since written / since detected):")
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=workers) as computer, ThreadPoolExecutor(max_workers=workers) as renderer:
+        stages = [(load, reader, 1),
+                  (partial(compute, resolution=resolution), computer, workers),
+                  (partial(render_fast, saveto=saveto), renderer, workers)]
+        try:
+            for filename in fpc.pipeline.run_pipeline(feed, stages, backlog=workers, stop=feed.stop):
+                latency = feed.latency(filename)
+                latencies.append(latency)
+                print(f"{filename.name}  {latency[0]:6.2f} s / {latency[1]:6.2f} s  (dropped so far: {len(feed.dropped)})")
+        except KeyboardInterrupt:
+            print("\nStopped.")
+
+    # Summarise the latency and dropped frames
+    if latencies:
+        latencies = np.array(latencies)
+        print(f"\nProcessed {len(latencies)} files; dropped {len(feed.dropped)}.")
+        print(f"Latency since written: median {np.median(latencies[:, 0]):.2f} s, 95th percentile {np.percentile(latencies[:, 0], 95):.2f} s, maximum {latencies[:, 0].max():.2f} s.")
+        print(f"Latency since detected: median {np.median(latencies[:, 1]):.2f} s, 95th percentile {np.percentile(latencies[:, 1], 95):.2f} s, maximum {latencies[:, 1].max():.2f} s.")
+    else:
+        print("\nNo files were processed.")
+
+    # Summarise the processing stages
+    if log is not None:
+        fpc.instrumentation.print_summary()
+        fpc.instrumentation.disable()
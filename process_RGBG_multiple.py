@@ -2,60 +2,163 @@
 Simple data processing for images from the RGBG polarisation camera.
 Demosaicking is done by splitting the image into its components.
 
+The processing is pipelined: files are read by one thread, processed by a pool
+of compute threads, and rendered/saved by a pool of render workers, all at the
+same time. Bounded queues between these stages keep the memory use in check.
+
 Call signature:
-    python process_RGBG_multiple.py my_folder/
+    python process_RGBG_multiple.py my_folder/ [stepsize] [workers] [renderer] [log] [resolution] [selection] [downsample]
+
+`stepsize` sets which files are processed (every `stepsize`th file, default 100;
+use 1 for all files). `workers` is the number of compute and render workers each
+(default: number of CPUs). `renderer` is either `fast` (default), which writes
+colour-mapped images directly, or `figure`, which makes matplotlib figures with
+colour bars (much slower). If `log` is given, the time, CPU time, and data read
+in each processing stage are recorded per file in this JSON-lines file (see
+`fpc.instrumentation`), and summarised at the end (use `-` to skip it).
+`resolution` is `full` (default), or `half` or `quarter` for quick-looks
+calculated per superpixel without interpolation, which is much faster (see
+`fpc.stokes.raw_to_stokes_superpixel`).
+If `selection` is given, e.g. `max_fraction_saturated=0,min_mean=2000`, only the
+files within these limits are processed, using the quality index of the folder
+(see `fpc.quality` and tools/index_folder.py), which is updated first; the
+`stepsize` then applies to the selected files (use `-` to skip the selection).
+`downsample` (default 1) reduces the resolution of the saved images by an
+integer factor, with the `fast` renderer. Rendering and writing the three
+panels of a full-resolution frame takes ~1 s per worker, which limits the
+throughput; with `downsample` 4 this is ~70 ms (~14 frames/s per worker), and
+with 8 ~20 ms.
 """
 from sys import argv
 from pathlib import Path
-from os import mkdir
+from os import mkdir, cpu_count
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
+import matplotlib
 from matplotlib import pyplot as plt
-import spectacle
 import fpc
 
-# Get the filename from the command line
-data_folder = Path(argv[1])
-filenames = list(data_folder.glob("*.raw"))
-print(f"Loading data from {data_folder.absolute()}")
-
-# Where to save the results
-data_label = f"{data_folder.parent.stem}_{data_folder.stem}"
-saveto = Path("E:/blackfly_processed/") / data_label
-try:
-    mkdir(saveto)
-except FileExistsError:
-    pass
-
-print(f"Processed images will be saved in {saveto.absolute()}")
-
-# Step size
-stepsize = 100
-print(f"Looping in steps of {stepsize}; total of {len(filenames)} files. Subset of {len(filenames)/stepsize:.0f} (+- 1) files will be processed.")
-
-# Loop over the filenames
-print("\nNow processing:")
-for filename in filenames[::stepsize]:
-    print(filename)
-    label = filename.stem
 
-    # Load the RAW file as an array
-    img = fpc.io.load_image_blackfly(filename, mask_saturated=True)
+def load(filename):
+    """
+    Load a RAW file as a masked array.
+    """
+    with fpc.instrumentation.frame(filename.stem):
+        img = fpc.io.load_image_blackfly(filename, mask_saturated=True)
+    return filename, img
+
 
-    # Demosaicking
-    img_demosaicked = fpc.stokes.demosaick_RGB(img)  # Dimensions: [x, y, RGB, Polarisers]
-    # img_demosaicked = np.moveaxis(img_demosaicked, (0, 1), (-2, -1))  # Move image axes to the end
+def compute(item, resolution="full"):
+    """
+    Calculate the intensity, DoLP, and AoLP in the G channel of a RAW image, at full resolution or per superpixel (see `fpc.stokes.raw_to_lp`).
+    The results are only rendered to 8-bit images, so they are calculated in float32.
+    """
+    filename, img = item
 
-    # Calculate the Stokes vector
-    img_stokes = fpc.stokes.convert_demosaicked_image_to_stokes(img_demosaicked)  # Dimensions: [x, y, RGB, IQU]
-    img_intensity, img_dolp, img_aolp = fpc.stokes.convert_stokes_to_lp(img_stokes)
+    # Demosaicking and Stokes vector in one pass
+    with fpc.instrumentation.frame(filename.stem):
+        img_intensity, img_dolp, img_aolp = fpc.stokes.raw_to_lp(img, dtype=np.float32, resolution=resolution)  # Dimensions: [x, y, RGB]
 
     # Separate the G images out
     G_intensity, G_dolp, G_aolp = img_intensity[..., 1], img_dolp[..., 1], img_aolp[..., 1]
 
-    # Show the result
-    fpc.plot.show_intensity_dolp_aolp(G_intensity, G_dolp, G_aolp, cmap_dolp=plt.cm.get_cmap("cividis", 4), saveto=saveto/f"{label}_G.png")
+    return filename, G_intensity, G_dolp, G_aolp
+
+
+def initialise_renderer(log=None):
+    """
+    Set up a render process to save figures without a display, and to record its stages in `log` if desired.
+    """
+    matplotlib.use("Agg")
+    if log is not None:
+        fpc.instrumentation.enable(saveto=log)
+
+
+def render_fast(item, saveto, downsample=1):
+    """
+    Save the intensity, DoLP, and AoLP in the G channel as colour-mapped images, without a matplotlib figure.
+    `downsample` reduces the resolution of the images by an integer factor, for quick previews (see `fpc.render`).
+    """
+    filename, G_intensity, G_dolp, G_aolp = item
+    label = filename.stem
+    with fpc.instrumentation.frame(label):
+        fpc.render.save_intensity_dolp_aolp(G_intensity, G_dolp, G_aolp, cmap_dolp=plt.cm.get_cmap("cividis", 4), saveto=saveto/f"{label}_G.png", downsample=downsample)
+    return filename
+
+
+def render_figure(item, saveto):
+    """
+    Plot the intensity, DoLP, and AoLP in the G channel and save the figure.
+    """
+    filename, G_intensity, G_dolp, G_aolp = item
+    label = filename.stem
+    with fpc.instrumentation.frame(label):
+        fpc.plot.show_intensity_dolp_aolp(G_intensity, G_dolp, G_aolp, cmap_dolp=plt.cm.get_cmap("cividis", 4), saveto=saveto/f"{label}_G.png")
     # fpc.plot.show_intensity_dolp_aolp_RGB_separate(img_intensity, img_dolp, img_aolp, title=label, saveto=saveto/f"{label}.png")
     # fpc.plot.show_intensity_dolp_aolp_RGB(img_intensity, img_dolp, img_aolp, title=label, saveto=saveto/f"{label}_RGB.png")
+    return filename
+
+
+if __name__ == "__main__":
+    # Get the filename from the command line
+    data_folder = Path(argv[1])
+    filenames = list(data_folder.glob("*.raw"))
+    print(f"Loading data from {data_folder.absolute()}")
+
+    # Where to save the results
+    data_label = f"{data_folder.parent.stem}_{data_folder.stem}"
+    saveto = Path("E:/blackfly_processed/") / data_label
+    try:
+        mkdir(saveto)
+    except FileExistsError:
+        pass
+
+    print(f"Processed images will be saved in {saveto.absolute()}")
+
+    # Step size, number of workers, and renderer
+    stepsize = int(argv[2]) if len(argv) > 2 else 100
+    workers = int(argv[3]) if len(argv) > 3 else cpu_count()
+    renderer_type = argv[4] if len(argv) > 4 else "fast"
+    log = Path(argv[5]) if len(argv) > 5 and argv[5] != "-" else None
+    resolution = argv[6] if len(argv) > 6 else "full"
+    selection = dict(limit.split("=") for limit in argv[7].split(",")) if len(argv) > 7 and argv[7] != "-" else None
+    downsample = int(argv[8]) if len(argv) > 8 else 1
+
+    # Select files from the quality index if desired, without reading the data again
+    if selection is not None:
+        with fpc.quality.index_folder(data_folder, workers=workers) as index:
+            filenames = index.select(**{key: float(value) for key, value in selection.items()})
+        print(f"Selected {len(filenames)} files with {selection}.")
+    print(f"Looping in steps of {stepsize}; total of {len(filenames)} files. Subset of {len(filenames)/stepsize:.0f} (+- 1) files will be processed.")
+    print(f"Using {workers} compute threads and {workers} render workers ({renderer_type}), at {resolution} resolution, saving images downsampled by {downsample}.")
+
+    # Fast rendering is thread-safe; matplotlib figures need separate processes
+    if renderer_type == "fast":
+        render, renderer = partial(render_fast, downsample=downsample), ThreadPoolExecutor(max_workers=workers)
+    elif renderer_type == "figure":
+        render, renderer = render_figure, ProcessPoolExecutor(max_workers=workers, initializer=initialise_renderer, initargs=(log,))
+    else:
+        raise ValueError(f"Unknown renderer `{renderer_type}`; use `fast` or `figure`.")
+
+    # Record the processing stages if desired
+    if log is not None:
+        fpc.instrumentation.enable(saveto=log)
+        print(f"Processing stages will be recorded in {log.absolute()}")
+
+    # Run the files through the pipeline: read -> compute -> render
+    print("\nNow processing:")
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=workers) as computer, renderer:
+        stages = [(load, reader, 1),
+                  (partial(compute, resolution=resolution), computer, workers),
+                  (partial(render, saveto=saveto), renderer, workers)]
+        for filename in fpc.pipeline.run_pipeline(filenames[::stepsize], stages, backlog=workers):
+            print(filename)
+
+    # Summarise the processing stages, including those in render processes
+    if log is not None:
+        fpc.instrumentation.disable()
+        fpc.instrumentation.print_summary(fpc.instrumentation.read_records(log))
 
 
 # # Extra plot
@@ -1,24 +1,245 @@
 """
-Script for sorting out files for the data release
+Script for sorting out files for the data release: a sample of the RAW files in
+one or more source folders is copied to a release folder, with checksums.
+
+From each source folder, `nrsample` files (default 100) are selected: every
+(number of files // `nrsample`)th file in sorted order, as in earlier releases,
+so the same files are selected every time. They are copied to
+`destination/<parent folder>/<folder>`, together with their sidecar files
+(.json), by a pool of `workers` threads at the same time. If the source
+and destination are on the same file system, files are cloned (reflink, where
+supported) or hard-linked instead of copied.
+
+Each file is hashed (SHA-256) while it is copied. Every file that is done is
+recorded in a manifest in the destination (`release_manifest.jsonl`), so an
+interrupted run can be resumed: files whose copy still matches the manifest
+(same size and modification time, or the same checksum with `verify=full`) are
+skipped. Files are written under a temporary name and only renamed when they
+are complete. At the end, a checksum file (`SHA256SUMS`) is written for the
+whole release, which can be checked with `sha256sum -c SHA256SUMS`.
+
+Call signature:
+    python sample_files.py destination/ source_folder1/ [source_folder2/ ...] [nrsample=100] [workers=8] [mode=auto] [verify=quick] [pattern=*.[Rr]aw]
+
+`mode` is `auto` (default: clone or hard-link where possible, copy otherwise) or
+`copy` (always copy). `verify` is `quick` (default: compare sizes and
+modification times) or `full` (re-hash the files already in the release).
 """
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha256
 from pathlib import Path
-from shutil import copy
 from sys import argv
 
-source = Path(argv[1])
-datafiles = sorted(source.glob("*.Raw"))
-identifier = f"{source.parts[-2]}/{source.parts[-1]}"
+try:
+    import fcntl  # Used for cloning files (reflink); not available on Windows
+except ImportError:
+    fcntl = None
+
+# ioctl request for cloning a file on Linux (FICLONE), e.g. on Btrfs and XFS
+FICLONE = 0x40049409
+
+# Names of the manifest and checksum files in the destination
+manifest_name = "release_manifest.jsonl"
+checksums_name = "SHA256SUMS"
+
+# Suffix of files that are still being written
+partial_suffix = ".part"
+
+
+def sample_files(datafiles, nrsample=100):
+    """
+    Select `nrsample` files from a sorted list of `datafiles`: every (number of files // `nrsample`)th file, starting with the first, up to `nrsample` files.
+    This is the same selection as in earlier releases, so existing releases are reproduced exactly. All files are selected if there are fewer than `nrsample`.
+    """
+    nrfiles = len(datafiles)
+    if nrfiles < nrsample:
+        return list(datafiles)
+    divider = nrfiles // nrsample
+    return datafiles[::divider][:nrsample]  # Sometimes an additional file slips in due to rounding; the second slice removes it
+
+
+def hash_file(filename, blocksize=2**22):
+    """
+    Calculate the SHA-256 hash of a file, reading it in blocks.
+    """
+    hasher = sha256()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(blocksize), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def copy_and_hash(source, target, blocksize=2**22):
+    """
+    Copy `source` to `target` in blocks, hashing the data as they are copied. The data are flushed to disk before returning.
+    Returns the SHA-256 hash.
+    """
+    hasher = sha256()
+    with open(source, "rb") as file_in, open(target, "wb") as file_out:
+        for block in iter(lambda: file_in.read(blocksize), b""):
+            hasher.update(block)
+            file_out.write(block)
+        file_out.flush()
+        os.fsync(file_out.fileno())
+    return hasher.hexdigest()
+
+
+def clone(source, target):
+    """
+    Clone `source` to `target` without copying the data (reflink), if the file system supports it.
+    Returns True if the file was cloned; otherwise, no `target` is left behind.
+    """
+    if fcntl is None:
+        return False
+    try:
+        with open(source, "rb") as file_in, open(target, "wb") as file_out:
+            fcntl.ioctl(file_out.fileno(), FICLONE, file_in.fileno())
+    except OSError:
+        Path(target).unlink(missing_ok=True)
+        return False
+    return True
+
+
+def transfer(source, destination, mode="auto"):
+    """
+    Put a copy of `source` at `destination`, hashing it, via a temporary file that is renamed when it is complete.
+    With `mode` "auto", the file is cloned or hard-linked if possible, and copied otherwise; with "copy", it is always copied.
+    The modification time of the source is kept. Returns a manifest entry for the file.
+    """
+    partial = destination.with_name(destination.name + partial_suffix)
+    partial.unlink(missing_ok=True)
+    method = "copy"
+
+    try:
+        # Clone or hard-link the file if it is on the same file system, and hash the source; otherwise, copy and hash in one pass
+        if mode == "auto" and os.stat(source).st_dev == os.stat(destination.parent).st_dev:
+            if clone(source, partial):
+                method = "clone"
+            else:
+                try:
+                    os.link(source, partial)
+                    method = "link"
+                except OSError:
+                    pass
+        if method == "copy":
+            checksum = copy_and_hash(source, partial)
+        else:
+            checksum = hash_file(source)
+
+        # Keep the modification time, and move the complete file into place
+        if method != "link":
+            status = os.stat(source)
+            os.utime(partial, ns=(status.st_atime_ns, status.st_mtime_ns))
+        os.replace(partial, destination)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+    status = destination.stat()
+    return {"size": status.st_size, "mtime_ns": status.st_mtime_ns, "sha256": checksum, "method": method}
+
+
+def load_manifest(destination):
+    """
+    Load the manifest of a (partial) release in `destination`, as a dictionary of entries by relative path. Later entries replace earlier ones.
+    Incomplete lines, e.g. from an interrupted run, are ignored.
+    """
+    manifest = {}
+    try:
+        with open(destination / manifest_name) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                manifest[entry["path"]] = entry
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def is_verified(source, target, entry, verify="quick"):
+    """
+    Check if `target` is a complete copy of `source` according to its manifest `entry`: the size of the source and the size and modification time of the copy must match.
+    If `verify` is "full", the checksum of the copy must also match.
+    """
+    if entry is None or not target.exists():
+        return False
+    status = target.stat()
+    if entry["source_size"] != source.stat().st_size or entry["size"] != status.st_size or entry["mtime_ns"] != status.st_mtime_ns:
+        return False
+    if verify == "full" and hash_file(target) != entry["sha256"]:
+        return False
+    return True
+
+
+def find_files(sources, nrsample=100, pattern="*.[Rr]aw"):
+    """
+    Find the files to release from each folder in `sources`: a sample of the RAW files (see `sample_files`) and their sidecar files.
+    Returns a list of (source file, path in the release) pairs; the path in the release is `<parent folder>/<folder>/<file name>`.
+    """
+    files = []
+    for source in sources:
+        source = Path(source)
+        identifier = Path(source.resolve().parent.name) / source.resolve().name
+        for datafile in sample_files(sorted(source.glob(pattern)), nrsample=nrsample):
+            files.append((datafile, identifier / datafile.name))
+            sidecar = datafile.with_suffix(".json")
+            if sidecar.exists():
+                files.append((sidecar, identifier / sidecar.name))
+    return files
+
+
+if __name__ == "__main__":
+    # Get the destination, source folders, and options from the command line
+    destination = Path(argv[1])
+    sources = [argument for argument in argv[2:] if "=" not in argument]
+    options = dict(argument.split("=", 1) for argument in argv[2:] if "=" in argument)
+    nrsample = int(options.get("nrsample", 100))
+    workers = int(options.get("workers", 8))
+    mode = options.get("mode", "auto")
+    verify = options.get("verify", "quick")
+    pattern = options.get("pattern", "*.[Rr]aw")
+    if mode not in ("auto", "copy") or verify not in ("quick", "full"):
+        raise ValueError(f"Unknown mode `{mode}` or verification `{verify}`; use mode=auto/copy and verify=quick/full.")
+
+    # Find the files to release, and skip those that are already done
+    destination.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(destination)
+    files = find_files(sources, nrsample=nrsample, pattern=pattern)
+    todo = [(source, path) for source, path in files if not is_verified(source, destination / path, manifest.get(path.as_posix()), verify=verify)]
+    print(f"Found {len(files)} files in {len(sources)} folders; {len(files) - len(todo)} are already in the release, {len(todo)} will be copied to {destination.absolute()} using {workers} threads.")
 
-nrfiles = len(datafiles)
-nrsample = 100
-divider = nrfiles // nrsample
-selectedfiles = datafiles[::divider][:nrsample]  # Sometimes an additional file slips in due to rounding; the second slice removes it
+    # Copy the remaining files in parallel, recording each in the manifest when it is done
+    failed = []
+    with open(destination / manifest_name, "a") as manifest_file, ThreadPoolExecutor(max_workers=workers) as executor:
+        for _, path in todo:
+            (destination / path).parent.mkdir(parents=True, exist_ok=True)
+        for _, path in files:  # Remove partial files left by an interrupted run
+            (destination / path).with_name(path.name + partial_suffix).unlink(missing_ok=True)
+        futures = {executor.submit(transfer, source, destination / path, mode=mode): (source, path) for source, path in todo}
+        for future in as_completed(futures):
+            source, path = futures[future]
+            try:
+                entry = future.result()
+            except OSError as error:
+                failed.append(path)
+                print(f"Failed to copy {source}: {error}")
+                continue
+            entry = {"path": path.as_posix(), "source": str(source), "source_size": source.stat().st_size, **entry}
+            manifest[entry["path"]] = entry
+            manifest_file.write(json.dumps(entry) + "\n")
+            manifest_file.flush()
+            print(f"{entry['method'].capitalize()}: {source}  -->  {destination / path}")
 
-destination_general = Path("/media/oli4/O4B/Zenodo/BlackFly")
-destination_here = destination_general / identifier
-destination_here.mkdir(parents=True, exist_ok=True)
+    # Write the checksums of the whole release
+    with open(destination / checksums_name, "w") as file:
+        for path in sorted(manifest):
+            if (destination / path).exists():
+                file.write(f"{manifest[path]['sha256']}  {path}\n")
+    print(f"Checksums of {len(manifest)} files saved to {(destination / checksums_name).absolute()}")
 
-for file in selectedfiles:
-    newfile = destination_here / file.name
-    copy(file, newfile)
-    print("Copied to", newfile)
+    if failed:
+        raise SystemExit(f"{len(failed)} files could not be copied; run this script again to retry them.")
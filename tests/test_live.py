@@ -0,0 +1,72 @@
+"""
+Tests for fpc.live: files that are still being written when watching starts.
+"""
+import time
+from threading import Thread
+import numpy as np
+import fpc
+
+# Width of a full frame; files with whole rows of this width are valid (region of interest) images
+width = fpc.io.full_shape[1]
+
+
+def _write_rows(filename, nr_rows, mode="wb"):
+    """
+    Write `nr_rows` full-width rows of 16-bit pixels to `filename`.
+    """
+    with open(filename, mode) as file:
+        np.zeros((nr_rows, width), dtype=np.uint16).tofile(file)
+
+
+def _collect(feed):
+    """
+    Iterate over `feed` in a separate thread, collecting the filenames it yields.
+    """
+    results = []
+    thread = Thread(target=lambda: results.extend(feed), daemon=True)
+    thread.start()
+    return thread, results
+
+
+def _feed(folder, **kwargs):
+    return fpc.live.LiveFeed(folder, interval=0.05, settle=1.0, idle_timeout=2.0, **kwargs)
+
+
+def test_file_growing_at_start_is_processed(tmp_path):
+    # A complete file from before, and one that the camera is still writing (already a valid full-width region of interest)
+    _write_rows(tmp_path/"old.raw", 8)
+    _write_rows(tmp_path/"f000.raw", 4)
+
+    feed = _feed(tmp_path)
+    thread, results = _collect(feed)
+    time.sleep(0.3)
+    _write_rows(tmp_path/"f000.raw", 4, mode="ab")
+    thread.join(timeout=10)
+
+    assert results == [tmp_path/"f000.raw"]
+    assert feed.dropped == []
+
+
+def test_incomplete_file_at_start_is_processed(tmp_path):
+    # With a fixed shape, the half-written file is not a valid image yet
+    _write_rows(tmp_path/"f000.raw", 4)
+
+    feed = _feed(tmp_path, shape=(8, width))
+    thread, results = _collect(feed)
+    time.sleep(0.3)
+    _write_rows(tmp_path/"f000.raw", 4, mode="ab")
+    thread.join(timeout=10)
+
+    assert results == [tmp_path/"f000.raw"]
+
+
+def test_complete_files_at_start_are_skipped(tmp_path):
+    _write_rows(tmp_path/"old.raw", 8)
+
+    feed = _feed(tmp_path)
+    thread, results = _collect(feed)
+    time.sleep(0.3)
+    _write_rows(tmp_path/"new.raw", 8)
+    thread.join(timeout=10)
+
+    assert results == [tmp_path/"new.raw"]
@@ -0,0 +1,45 @@
+"""
+Tests for fpc.quality: files that disappear while the index is updated.
+"""
+from pathlib import Path
+import numpy as np
+import fpc
+
+
+def _write_frame(filename, value):
+    """
+    Write a small full-width RAW image (region of interest) with a constant `value`.
+    """
+    np.full((8, fpc.io.full_shape[1]), value, dtype=np.uint16).tofile(filename)
+
+
+def test_file_removed_between_glob_and_stat(tmp_path, monkeypatch):
+    for i in range(3):
+        _write_frame(tmp_path/f"f{i:03d}.raw", 1000 * (i+1))
+
+    # Remove one file right after the folder has been listed
+    glob = Path.glob
+    def glob_then_remove(self, pattern, *args, **kwargs):
+        filenames = list(glob(self, pattern, *args, **kwargs))
+        (tmp_path/"f001.raw").unlink(missing_ok=True)
+        return filenames
+    monkeypatch.setattr(Path, "glob", glob_then_remove)
+
+    with fpc.quality.QualityIndex(tmp_path) as index:
+        assert index.update() == 2
+        assert [filename.name for filename in index.select()] == ["f000.raw", "f002.raw"]
+
+        # The next update finds nothing new, and the missing file stays out of the index
+        monkeypatch.undo()
+        assert index.update() == 0
+        assert len(index) == 2
+
+
+def test_select_limits(tmp_path):
+    for i in range(3):
+        _write_frame(tmp_path/f"f{i:03d}.raw", 1000 * (i+1))
+    _write_frame(tmp_path/"saturated.raw", 65535)
+
+    with fpc.quality.index_folder(tmp_path) as index:
+        assert [filename.name for filename in index.select(max_fraction_saturated=0, min_mean=1500)] == ["f001.raw", "f002.raw"]
+        assert index.table()["fraction_saturated"].max() == 1
@@ -0,0 +1,261 @@
+"""
+Benchmark the processing of RAW images, from loading to Stokes parameters to
+plots, on synthetic data. This makes it possible to check if a change to this
+repository, or an upgrade of polanalyser, spectacle, numpy, or matplotlib, made
+the processing slower or more memory-hungry.
+
+Synthetic 2048x2448 uint16 polarisation mosaics are generated (with and without
+saturated pixels) and written to a temporary folder, so no data or network
+access are needed. Each step is run several times; the fastest and median run
+times, throughput (frames and megabytes of RAW data per second), and peak
+memory use (of numpy arrays, measured in a separate run) are printed and saved
+to a JSON file, together with the versions of the main dependencies.
+
+If a previous results file is given, the median run times are compared to it
+and any steps that became more than 10% slower are listed.
+
+Command line arguments:
+    * `saveto`: JSON file to save the results to.
+    Optional:
+    * `repeats`: number of times to run each step. Defaults to 3.
+    * `baseline`: JSON file with previous results, to compare to.
+"""
+
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from importlib import metadata, util
+from os import cpu_count
+from pathlib import Path
+from statistics import median
+from sys import argv
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import fpc
+
+# Size of the synthetic images and number of frames for stacking
+shape = (2048, 2448)
+nr_frames_stack = 10
+
+# Fraction of the median run time by which a step may become slower before it is reported
+tolerance = 0.1
+
+# Polariser angle (degrees) and colour gain for each pixel in the repeating 4x4 pattern
+polariser_angles = {(0, 0): 90, (0, 1): 45, (1, 0): 135, (1, 1): 0}
+colour_gains = {(0, 0): 0.6, (0, 1): 1.0, (1, 0): 1.0, (1, 1): 0.4}  # R, G, G, B
+
+
+def synthetic_mosaic(shape=shape, saturated=False, seed=0):
+    """
+    Generate a synthetic RAW image (uint16) of a smooth, partially polarised scene, as seen through the polariser and colour filters of the camera.
+    If `saturated` is True, a bright spot and 1% of random pixels are saturated.
+    """
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(0, 1, shape[1], dtype=np.float32), np.linspace(0, 1, shape[0], dtype=np.float32))
+
+    # Smooth scene: intensity gradient, DoLP 0-0.4, AoLP rotating across the image
+    intensity = 30000 * (0.5 + 0.5 * x * y)
+    dolp = 0.4 * x
+    aolp = np.pi * y
+
+    # Observed intensity behind each polariser and colour filter (Malus's law)
+    img = np.empty(shape, dtype=np.float32)
+    for i in range(4):
+        for j in range(4):
+            angle = np.deg2rad(polariser_angles[(i % 2, j % 2)])
+            gain = colour_gains[(i // 2, j // 2)]
+            s = np.s_[i::4, j::4]
+            img[s] = gain * intensity[s] * (1 + dolp[s] * np.cos(2 * (angle - aolp[s])))
+
+    # Add noise and convert to integers
+    img += rng.normal(0, 50, size=shape).astype(np.float32)
+    img = np.clip(img, 0, 65535).astype(np.uint16)
+
+    # Saturate a bright spot and some random pixels
+    if saturated:
+        img[np.hypot(x - 0.7, y - 0.3) < 0.1] = 65535
+        img.ravel()[rng.choice(img.size, size=img.size // 100, replace=False)] = 65535
+
+    return img
+
+
+def load_tool(name):
+    """
+    Import one of the scripts in the `tools` folder as a module, without running its main section.
+    """
+    spec = util.spec_from_file_location(name, Path(__file__).parent/f"{name}.py")
+    module = util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_benchmark(function, repeats=3, nr_frames=1):
+    """
+    Run `function` `repeats` times and measure its run time, then run it once more to measure its peak memory use (with tracemalloc, which slows it down).
+    Returns a dictionary with the results.
+    """
+    # Measure the run time
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    # Measure the peak memory use in a separate run
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    time_median = median(times)
+    nr_bytes = nr_frames * shape[0] * shape[1] * 2
+    result = {"times": times,
+              "best": min(times),
+              "median": time_median,
+              "frames_per_second": nr_frames / time_median,
+              "MB_per_second": nr_bytes / time_median / 1e6,
+              "peak_memory_MB": peak / 1e6}
+
+    return result
+
+
+def benchmark_cases(folder, label, img):
+    """
+    Create the benchmarks for one synthetic image `img`, saved in `folder`.
+    Returns a dictionary of names and functions (with the number of frames they process).
+    """
+    filename = folder/f"{label}.raw"
+    img.tofile(filename)
+
+    # Intermediate products, so each step can be timed separately
+    img_masked = fpc.io.load_image_blackfly(filename, mask_saturated=True)
+    img_demosaicked = fpc.stokes.demosaick_RGB(img_masked)
+    img_stokes = fpc.stokes.convert_demosaicked_image_to_stokes(img_demosaicked)
+    img_intensity, img_dolp, img_aolp = fpc.stokes.convert_stokes_to_lp(img_stokes)
+    G_intensity, G_dolp, G_aolp = img_intensity[..., 1], img_dolp[..., 1], img_aolp[..., 1]
+    workspace = fpc.stokes.Workspace()
+
+    cases = {"io.load_image_blackfly": (lambda: fpc.io.load_image_blackfly(filename), 1),
+             "io.load_image_blackfly (masked)": (lambda: fpc.io.load_image_blackfly(filename, mask_saturated=True), 1),
+             "stokes.demosaick_RGB": (lambda: fpc.stokes.demosaick_RGB(img_masked), 1),
+             "stokes.convert_demosaicked_image_to_stokes": (lambda: fpc.stokes.convert_demosaicked_image_to_stokes(img_demosaicked), 1),
+             "stokes.convert_stokes_to_lp": (lambda: fpc.stokes.convert_stokes_to_lp(img_stokes), 1),
+             "stokes.raw_to_stokes": (lambda: fpc.stokes.raw_to_stokes(img_masked), 1),
+             "stokes.raw_to_lp": (lambda: fpc.stokes.raw_to_lp(img_masked), 1),
+             "stokes.raw_to_lp (workspace)": (lambda: fpc.stokes.raw_to_lp(img_masked, workspace=workspace), 1),
+             "stokes.raw_to_lp (float32)": (lambda: fpc.stokes.raw_to_lp(img_masked, dtype=np.float32), 1),
+             "stokes.raw_to_lp (quarter)": (lambda: fpc.stokes.raw_to_lp(img_masked, resolution="quarter"), 1),
+             "plot.show_testplot": (lambda: fpc.plot.show_testplot(img_masked, saveto=folder/"testplot.png"), 1),
+             "plot.show_intensity_dolp_aolp": (lambda: fpc.plot.show_intensity_dolp_aolp(G_intensity, G_dolp, G_aolp, saveto=folder/"figure.png"), 1),
+             "render.save_intensity_dolp_aolp": (lambda: fpc.render.save_intensity_dolp_aolp(G_intensity, G_dolp, G_aolp, saveto=folder/"render.png"), 1)}
+
+    cases = {f"{name} [{label}]": case for name, case in cases.items()}
+    return cases
+
+
+def stacking_case(folder):
+    """
+    Create the benchmark for tools/stack_mean_std.py, stacking `nr_frames_stack` synthetic images.
+    """
+    stack_mean_std = load_tool("stack_mean_std")
+
+    # Write the frames into their own folder
+    folder_here = folder/"images"/"stack"
+    folder_here.mkdir(parents=True)
+    for seed in range(nr_frames_stack):
+        synthetic_mosaic(seed=seed).tofile(folder_here/f"frame_{seed}.raw")
+    raw_files = sorted(folder_here.glob("*.raw"))
+    inputs = stack_mean_std.describe_inputs(raw_files)
+    goal = folder/"stacks"/"stack"
+
+    return {"tools/stack_mean_std.py": (lambda: stack_mean_std.stack_folder(folder_here, goal, raw_files, inputs), nr_frames_stack)}
+
+
+def describe_environment():
+    """
+    Describe the machine and the versions of the main dependencies.
+    """
+    import cv2
+    versions = {"numpy": np.__version__, "matplotlib": matplotlib.__version__, "opencv": cv2.__version__}
+    for package in ("polanalyser", "pyspectacle", "cmcrameri"):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = "unknown"
+    environment = {"date": datetime.now().isoformat(timespec="seconds"),
+                   "platform": platform.platform(),
+                   "processor": platform.processor(),
+                   "cpu_count": cpu_count(),
+                   "python": platform.python_version(),
+                   "versions": versions}
+    return environment
+
+
+def compare(results, baseline):
+    """
+    Compare the median run times in `results` to those in `baseline` and print them.
+    Returns a list of the steps that became slower by more than `tolerance`.
+    """
+    regressions = []
+    print(f"\n{'Step':<70} {'Baseline':>10} {'Now':>10} {'Ratio':>7}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]["median"], result["median"]
+        ratio = new / old
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  SLOWER"
+        print(f"{name:<70} {old:>9.3f}s {new:>9.3f}s {ratio:>7.2f}{flag}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    # Get the save location, number of repeats, and baseline from the command line
+    saveto = Path(argv[1])
+    repeats = int(argv[2]) if len(argv) > 2 else 3
+    baseline_file = Path(argv[3]) if len(argv) > 3 else None
+
+    environment = describe_environment()
+    print(f"Benchmarking on {environment['platform']} ({environment['cpu_count']} CPUs) with {repeats} repeats")
+    print(f"Versions: {environment['versions']}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+
+        # Set up all benchmarks
+        cases = {}
+        for label, saturated in [("clean", False), ("saturated", True)]:
+            cases.update(benchmark_cases(folder, label, synthetic_mosaic(saturated=saturated)))
+        cases.update(stacking_case(folder))
+
+        # Run the benchmarks
+        for name, (function, nr_frames) in cases.items():
+            result = run_benchmark(function, repeats=repeats, nr_frames=nr_frames)
+            results[name] = result
+            print(f"{name:<70} {result['median']:>8.3f} s  {result['frames_per_second']:>7.2f} frames/s  {result['MB_per_second']:>8.1f} MB/s  {result['peak_memory_MB']:>7.1f} MB peak")
+
+    # Save the results
+    saveto.parent.mkdir(parents=True, exist_ok=True)
+    with open(saveto, "w") as file:
+        json.dump({"environment": environment, "shape": shape, "repeats": repeats, "results": results}, file, indent=1)
+    print(f"Saved results to {saveto}")
+
+    # Compare to a baseline if desired
+    if baseline_file is not None:
+        with open(baseline_file) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline["results"])
+        if regressions:
+            print(f"\n{len(regressions)} steps became more than {tolerance:.0%} slower than in {baseline_file} ({baseline['environment']['date']}):")
+            for name in regressions:
+                print(f"    {name}")
+        else:
+            print(f"\nNo steps became more than {tolerance:.0%} slower than in {baseline_file}.")
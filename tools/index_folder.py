@@ -0,0 +1,47 @@
+"""
+Build or update the quality index of the RAW images in a folder (see
+`fpc.quality`): the minimum, maximum, and mean RAW value, the fraction of
+saturated pixels, and the time each image was written, saved in a SQLite
+database (`fpc_quality.sqlite`) in the folder. Only new or changed images are
+read, so re-running this after adding data is fast.
+
+The processing scripts can then select frames from the index without reading
+the data again, e.g. `process_RGBG_multiple.py` with a selection such as
+`max_fraction_saturated=0,min_mean=2000`.
+
+Command line arguments:
+    * `folder`: folder containing RAW images.
+    Optional:
+    * `workers=N`: number of worker processes. Defaults to the number of CPUs.
+    * `stride=N`: sample every Nth 4x4 block row and column (default 4); use 1
+        to read every pixel and get exact values.
+    * `database=path`: where to save the index, if not in the folder (e.g. for
+        read-only data).
+"""
+
+from sys import argv
+from pathlib import Path
+from os import cpu_count
+from time import perf_counter
+import numpy as np
+import fpc
+
+if __name__ == "__main__":
+    # Get the data folder and options from the command line
+    folder = Path(argv[1])
+    options = dict(argument.split("=") for argument in argv[2:])
+    workers = int(options.get("workers", cpu_count()))
+    stride = int(options.get("stride", 4))
+    database = options.get("database")
+
+    # Update the index
+    start = perf_counter()
+    with fpc.quality.QualityIndex(folder, database=database) as index:
+        nr_indexed = index.update(workers=workers, stride=stride)
+        print(f"Indexed {nr_indexed} new or changed files in {perf_counter() - start:.1f} s using {workers} workers; {len(index)} files in {index.database.absolute()}")
+
+        # Summarise the index
+        table = index.table()
+    if len(table) > 0:
+        print(f"Mean RAW value: {table['mean'].min():.0f} - {table['mean'].max():.0f} (median {np.median(table['mean']):.0f})")
+        print(f"Files with saturated pixels: {np.count_nonzero(table['fraction_saturated'] > 0)}; maximum saturated fraction {100*table['fraction_saturated'].max():.2f}%")
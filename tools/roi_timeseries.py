@@ -0,0 +1,61 @@
+"""
+Extract time series of the polarisation in one or more regions of interest
+(ROIs) from all RAW images in a folder, in the order of their filenames.
+
+Only the ROIs, plus a margin for the demosaicking, are read from each image, so
+this is much faster than processing the full frames. For each frame, ROI, and
+colour channel, the mean Stokes parameters, the DoLP and AoLP of the mean Stokes
+vector, and the mean and (circular) standard deviation of the DoLP and AoLP per
+pixel are saved to a CSV table (see `fpc.timeseries`). Saturated pixels are
+ignored.
+
+Command line arguments:
+    * `folder`: folder containing RAW images.
+    * `saveto`: CSV file to save the table to.
+    * `rois`: one or more ROIs, given as `name=top:bottom,left:right` in
+        pixels, e.g. `panel=500:600,700:800 sky=0:200,1000:1400`.
+    Optional:
+    * `workers=N`: number of worker processes. Defaults to the number of CPUs.
+"""
+
+from sys import argv
+from pathlib import Path
+from os import cpu_count
+from time import perf_counter
+import numpy as np
+import fpc
+
+
+def parse_roi(text):
+    """
+    Parse an ROI given as `name=top:bottom,left:right` into its name and region.
+    """
+    name, region = text.split("=")
+    rows, columns = [slice(*[int(value) for value in part.split(":")]) for part in region.split(",")]
+    return name, np.s_[rows, columns]
+
+
+if __name__ == "__main__":
+    # Get the data folder, save location, ROIs, and number of workers from the command line
+    folder = Path(argv[1])
+    saveto = Path(argv[2])
+    workers = cpu_count()
+    rois = {}
+    for argument in argv[3:]:
+        if argument.startswith("workers="):
+            workers = int(argument.split("=")[1])
+        else:
+            name, region = parse_roi(argument)
+            rois[name] = region
+    if not rois:
+        raise ValueError("Please provide at least one ROI, e.g. `panel=500:600,700:800`.")
+
+    filenames = sorted(folder.glob("*.raw"))
+    print(f"Extracting {len(rois)} ROIs ({', '.join(rois)}) from {len(filenames)} images in {folder.absolute()}, using {workers} workers")
+
+    # Extract the time series
+    start = perf_counter()
+    saveto.parent.mkdir(parents=True, exist_ok=True)
+    table = fpc.timeseries.extract_timeseries(filenames, rois, saveto=saveto, workers=workers)
+    time_taken = perf_counter() - start
+    print(f"Saved {len(table)} rows to {saveto.absolute()} in {time_taken:.1f} s ({len(filenames)/time_taken:.1f} frames/s)")
@@ -1,9 +1,23 @@
 """
 Walk through a folder and create NPY stacks based on the images found. This
 script will walk through all the subfolders of a given folder and generate
-NPY stacks one level above the lowest level found. For example, in a given file
-structure `level1/level2/level3/image1.raw`, stacks will be generated at
-`level1/level2/level3_mean.npy` and `level1/level2/level3_stds.npy`.
+stacks one level above the lowest level found. For example, in a given file
+structure `level1/level2/level3/image1.raw`, NPY stacks containing the mean
+and standard deviation will be generated at `level1/level2/level3_mean.npy`
+and `level1/level2/level3_stds.npy`. Alternatively, a stack file (see
+`fpc.stackfile`) can be generated at `level1/level2/level3.fpcstack`; stack
+files are compressed and also contain the number of frames, the exposure time
+(if it can be read from the folder name), and the source files.
+
+Images are read one at a time, so memory use does not depend on the number of
+images in a folder. Folders are processed in parallel by a pool of worker
+processes.
+
+Next to each pair of stacks, a manifest `level1/level2/level3_manifest.json`
+is saved, listing the input files (with their sizes and modification times) and
+the output files (with their sizes and SHA-256 hashes). Folders whose inputs
+and outputs still match their manifest are skipped, so re-running the script
+after adding new data only processes the new folders.
 
 By default, the save folder is the same as the data folder, but with `images`
 replaced with `stacks`.
@@ -11,49 +25,167 @@ replaced with `stacks`.
 Command line arguments:
     * `folder`: folder containing data. Any RAW images in this folder and any
         of its subfolders will be stacked, as described above.
+    Optional:
+    * `workers`: number of worker processes. Defaults to the number of CPUs.
+    * `format`: "npy" (default) for NPY stacks or "fpcstack" for stack files.
 """
 
 import numpy as np
+import json
 from sys import argv
-from spectacle import io
-from os import walk, makedirs
+from pathlib import Path
+from string import ascii_letters
+from os import walk, makedirs, cpu_count
+from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import fpc
 
-# Get the data folder from the command line
-folder = io.path_from_input(argv)
-
 # Pattern for the raw files
 raw_pattern = "*.raw"
 
-# Walk through the folder and all its subfolders
-for tup in walk(folder):
-    # The current folder
-    folder_here = io.Path(tup[0])
+# Suffixes for the output files, per format
+output_suffixes = {"fpcstack": (fpc.stackfile.extension,), "npy": ("_mean.npy", "_stds.npy")}
+
+
+def describe_inputs(raw_files):
+    """
+    Describe a list of input files by their names, sizes, and modification times.
+    """
+    inputs = []
+    for filename in raw_files:
+        stat = filename.stat()
+        inputs.append({"name": filename.name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+    return inputs
+
+
+def hash_file(filename, blocksize=2**20):
+    """
+    Calculate the SHA-256 hash of a file, reading it in blocks.
+    """
+    hasher = sha256()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(blocksize), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def is_up_to_date(goal, inputs, suffixes):
+    """
+    Check if the stacks at `goal` are up to date, i.e. if their manifest describes the same `inputs` and all outputs (with `suffixes`) still exist with the right size.
+    """
+    # Load the manifest, if it exists
+    try:
+        with open(f"{goal}_manifest.json") as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+    # Check if the inputs have changed
+    if manifest.get("files") != inputs:
+        return False
+
+    # Check if the outputs still exist and have not been replaced
+    for suffix in suffixes:
+        output = Path(f"{goal}{suffix}")
+        if suffix not in manifest["outputs"] or not output.exists() or output.stat().st_size != manifest["outputs"][suffix]["size"]:
+            return False
+
+    return True
+
 
-    # The folder to save stacks to
-    goal = io.replace_word_in_path(folder_here, "images", "stacks")
+def replace_word_in_path(path, old, new):
+    """
+    Replace the folder `old` with `new` in `path`, like `spectacle.io.replace_word_in_path`.
+    spectacle is not imported here because importing it takes much longer than stacking a small folder.
+    """
+    parts = list(Path(path).parts)
+    parts[parts.index(old)] = new
+    return Path(*parts)
 
-    # Find all RAW files in this folder
-    raw_files = list(folder_here.glob(raw_pattern))
-    if len(raw_files) == 0:
-        # If there are no RAW files in this folder, move on to the next
-        continue
 
+def exposure_time_from_folder(folder_here):
+    """
+    Get the exposure time from the name of a folder, e.g. `t1000` or `t1_1000` (1/1000), like `spectacle.io.split_exposure_time`, if possible. Returns None otherwise.
+    """
+    without_letters = Path(folder_here).stem.strip(ascii_letters + "_")
+    try:
+        numerator, _, denominator = without_letters.partition("_")
+        return float(numerator) / float(denominator) if denominator else float(numerator)
+    except ValueError:
+        return None
+
+
+def stack_folder(folder_here, goal, raw_files, inputs, file_format="npy"):
+    """
+    Create mean and standard deviation stacks for the `raw_files` in a folder and save them, with a manifest, to `goal`.
+    `file_format` is "fpcstack" for a stack file or "npy" for NPY stacks.
+    """
     # Create the goal folder if it does not exist yet
     makedirs(goal.parent, exist_ok=True)
 
-    # Load all RAW files
-    arrs = fpc.io.load_image_blackfly_multi(raw_files)
+    # Open all RAW files lazily; frames are read one at a time
+    frames = fpc.io.FrameStack(raw_files)
+
+    # Calculate the mean and standard deviation per pixel
+    mean, stds = fpc.statistics.mean_and_std(frames, dtype=np.float32)
+
+    # Save the mean and standard deviation per pixel
+    if file_format == "npy":
+        np.save(f"{goal}_mean.npy", mean)
+        np.save(f"{goal}_stds.npy", stds)
+    else:
+        metadata = {"folder": str(folder_here), "nr_frames": len(raw_files), "exposure_time": exposure_time_from_folder(folder_here), "files": inputs}
+        fpc.stackfile.save_stack(f"{goal}{fpc.stackfile.extension}", {"mean": mean, "stds": stds}, metadata=metadata)
+    del mean, stds
+
+    # Save the manifest last, so an interrupted run is never considered up to date
+    outputs = {suffix: {"size": Path(f"{goal}{suffix}").stat().st_size, "sha256": hash_file(f"{goal}{suffix}")} for suffix in output_suffixes[file_format]}
+    manifest = {"folder": str(folder_here), "files": inputs, "outputs": outputs}
+    with open(f"{goal}_manifest.json", "w") as file:
+        json.dump(manifest, file, indent=1)
+
+    return folder_here, goal
+
+
+if __name__ == "__main__":
+    # Get the data folder, number of workers, and output format from the command line
+    folder = Path(argv[1])
+    workers = int(argv[2]) if len(argv) > 2 else cpu_count()
+    file_format = argv[3] if len(argv) > 3 else "npy"
+    if file_format not in output_suffixes:
+        raise ValueError(f"Unknown output format '{file_format}'; use one of {list(output_suffixes)}.")
+
+    # Walk through the folder and all its subfolders, and find those that need to be (re-)stacked
+    tasks = []
+    nr_up_to_date = 0
+    for tup in walk(folder):
+        # The current folder
+        folder_here = Path(tup[0])
+
+        # The folder to save stacks to
+        goal = replace_word_in_path(folder_here, "images", "stacks")
+
+        # Find all RAW files in this folder, in a fixed order
+        raw_files = sorted(folder_here.glob(raw_pattern))
+        if len(raw_files) == 0:
+            # If there are no RAW files in this folder, move on to the next
+            continue
+
+        # Skip this folder if its stacks are up to date
+        inputs = describe_inputs(raw_files)
+        if is_up_to_date(goal, inputs, output_suffixes[file_format]):
+            nr_up_to_date += 1
+            continue
+
+        tasks.append((folder_here, goal, raw_files, inputs))
 
-    # Calculate and save the mean per pixel
-    mean = arrs.mean(axis=0, dtype=np.float32)
-    np.save(f"{goal}_mean.npy", mean)
-    del mean
+    print(f"Found {len(tasks) + nr_up_to_date} folders with RAW files; {nr_up_to_date} are up to date, {len(tasks)} will be stacked using {workers} workers.")
 
-    # Calculate and save the standard deviation per pixel
-    stds = arrs.std(axis=0, dtype=np.float32)
-    np.save(f"{goal}_stds.npy", stds)
-    del stds, arrs
+    # Stack the remaining folders in parallel
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(stack_folder, *task, file_format=file_format) for task in tasks]
+        for future in as_completed(futures):
+            folder_here, goal = future.result()
 
-    # Print the input and output folder as confirmation
-    print(f"{folder_here}  -->  {goal}_x.npy")
+            # Print the input and output folder as confirmation
+            print(f"{folder_here}  -->  {goal}{'_x.npy' if file_format == 'npy' else fpc.stackfile.extension}")
@@ -0,0 +1,67 @@
+"""
+Average the Stokes parameters of all RAW images in a folder (a burst) into one
+de-noised product: the intensity, DoLP, and AoLP of the mean Stokes vector per
+pixel, with their uncertainties (see `fpc.stokes.StokesAccumulator`). The DoLP
+is corrected for the bias caused by the remaining noise. Saturated pixels are
+ignored per frame.
+
+Images are read and demosaicked one at a time, so memory use does not depend on
+the number of images in the folder. The product is saved to a stack file (see
+`fpc.stackfile`), together with the number of frames and the source files.
+
+If `window=N` is given, the average is taken over a sliding window of the last
+N frames instead, and a product is saved every `step` frames (default: N) once
+the window is full, with the index of its last frame added to the filename.
+
+Command line arguments:
+    * `folder`: folder containing RAW images.
+    * `saveto`: stack file to save the product to.
+    Optional:
+    * `window=N`: number of frames in a sliding window.
+    * `step=N`: number of frames between sliding-window products.
+"""
+
+from sys import argv
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import fpc
+
+
+def product(accumulator):
+    """
+    Get the maps from `accumulator` in float32, which is precise enough for saving and halves the file size.
+    """
+    return {name: data.astype(np.float32) for name, data in accumulator.result().items()}
+
+
+if __name__ == "__main__":
+    # Get the data folder, save location, and window from the command line
+    folder = Path(argv[1])
+    saveto = Path(argv[2])
+    options = dict(argument.split("=") for argument in argv[3:])
+    window = int(options["window"]) if "window" in options else None
+    step = int(options.get("step", window or 1))
+
+    filenames = sorted(folder.glob("*.raw"))
+    frames = fpc.io.FrameStack(filenames, mask_saturated=True)
+    print(f"Averaging the Stokes parameters of {len(filenames)} images in {folder.absolute()}" + (f" in a sliding window of {window} frames" if window else ""))
+
+    # Add the frames one at a time, saving a product whenever one is due
+    saveto.parent.mkdir(parents=True, exist_ok=True)
+    accumulator = fpc.stokes.StokesAccumulator(window=window)
+    start = perf_counter()
+    for index, img in enumerate(frames):
+        accumulator.add(img)
+        if window is not None and index + 1 >= window and (index + 1 - window) % step == 0:
+            goal = saveto.with_name(f"{saveto.stem}_{index:06d}{saveto.suffix}")
+            metadata = {"folder": str(folder), "nr_frames": accumulator.nr_frames, "files": [filename.name for filename in filenames[index+1-window:index+1]]}
+            fpc.stackfile.save_stack(goal, product(accumulator), metadata=metadata)
+            print(f"Frames {index+1-window}-{index}  -->  {goal}")
+
+    # Save the product of the whole burst
+    if window is None:
+        metadata = {"folder": str(folder), "nr_frames": accumulator.nr_frames, "files": [filename.name for filename in filenames]}
+        fpc.stackfile.save_stack(saveto, product(accumulator), metadata=metadata)
+        print(f"Saved to {saveto.absolute()}")
+    print(f"Processed {len(filenames)} frames in {perf_counter() - start:.1f} s")